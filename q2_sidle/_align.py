@@ -1,10 +1,7 @@
-import itertools as it
 import warnings
 
 warnings.filterwarnings('ignore', category=RuntimeWarning)
 
-import dask
-import dask.dataframe as dd
 import numpy as np
 import pandas as pd
 import regex
@@ -14,7 +11,11 @@ from q2_sidle._formats import KmerAlignFormat
 from q2_feature_classifier._skl import _chunks
 
 from q2_sidle._utils import (_setup_dask_client, 
-                             degen_sub2
+                             _count_dask_workers,
+                             _ordered_map,
+                             _count_set_nibbles,
+                             _pack_seqs,
+                             _packed_hamming,
                              )
 
 
@@ -23,9 +24,12 @@ def align_regional_kmers(kmers: DNAFASTAFormat,
     region: str, 
     max_mismatch: int=2, 
     chunk_size:int=100, 
+    method:str='exhaustive',
+    memory_budget:int=1000,
     debug:bool=False, 
     n_workers:int=1,
-    client_address:str=None) -> KmerAlignFormat:
+    client_address:str=None,
+    cluster_config:str=None) -> KmerAlignFormat:
     """
     Performs regional alignment between database "kmers" and ASVs
 
@@ -46,12 +50,33 @@ def align_regional_kmers(kmers: DNAFASTAFormat,
     max_mismatch: int
         the maximum number of mismatched nucleotides allowed in mapping 
         between a sequence and kmer.
+    chunk_size: int, optional
+        The number of kmers aligned against the ASVs in a single task. When 
+        the alignment is an exact join, blocks of `chunk_size * 100` kmers
+        are used.
+    method: {'exhaustive', 'pigeonhole'}, optional
+        How candidate kmer/ASV pairs are found. `"exhaustive"` compares every
+        kmer to every ASV. `"pigeonhole"` splits the sequences into 
+        `max_mismatch + 1` segments and only compares the pairs which share
+        at least one identical segment, which is guaranteed for any pair 
+        within `max_mismatch`. Both methods give the same alignment. When
+        `max_mismatch` is 0, the alignment is a join on the sequence and
+        `method` is ignored.
+    memory_budget: int, optional
+        The approximate memory (in megabytes) avaliable for the alignment
+        tiles being processed at once. Each finished block of `chunk_size` 
+        kmers is written to the output file as it completes, so the memory 
+        doesn't grow with the number of kmers.
     debug: bool
         Whether the function should be run in debug mode (without a client)
         or not. `debug` superceeds all options
     n_workers: int, optional
         The number of jobs to initiate. When `n_workers` is 0, the cluster 
         will be able to access all avaliable resources.
+    cluster_config: str, optional
+        A YAML or JSON file describing the dask cluster (the `scheduler`, 
+        `n_workers`, `threads_per_worker`, `memory_limit` and `processes`).
+        This superceeds `n_workers` and `client_address`.
 
     Returns
     -------
@@ -64,78 +89,116 @@ def align_regional_kmers(kmers: DNAFASTAFormat,
 
     """
      # Sets up the client
-    _setup_dask_client(debug=debug, cluster_config=None,  
-                       n_workers=n_workers, address=client_address)
-
-    # Converts the representative sequences to a delayed object
-    num_asvs, asv_length = _check_read_lengths(rep_seq, 'rep_seq')
-    rep_seq_ids  = rep_seq.index.values
-    rep_seq = dd.from_pandas(rep_seq.astype(str),
-                             chunksize=chunk_size)
-
-    ff = KmerAlignFormat()
-
-    # Performs the alignment
-    for i,  batch in enumerate(_chunks(kmers.view(DNAIterator), 
-                               chunk_size * 100)):
-       
-
-        if i == 0:
-            batch = pd.Series({s.metadata['id']: str(s) for s in batch})
-            num_kmers, kmer_length = _check_read_lengths(batch, 'kmer')
-
-            if kmer_length != asv_length:
-                raise ValueError('The kmer and ASV sequences must be the'
-                                 ' same length')
-            batch = dd.from_pandas(batch, chunksize=chunk_size)
-        else:
-            batch = dd.from_pandas(
-                pd.Series({s.metadata['id']: str(s) for s in batch}),
-                chunksize=chunk_size
-                )
-
-        aligned_batch = np.hstack([
-            dask.delayed(_align_kmers)(kmer, asv, max_mismatch)
-            for kmer, asv in it.product(batch.to_delayed(), rep_seq.to_delayed())
-            ])
-
-        aligned_batch = pd.concat(axis=0, objs=dask.compute(*aligned_batch))
-
-        aligned_batch['region'] = region
-        aligned_batch['max-mismatch'] = max_mismatch
-        if i  == 0:
-            aligned_batch.to_csv(str(ff), sep='\t', index=False, 
-                                 mode='w')
+    with _setup_dask_client(debug=debug, cluster_config=cluster_config,
+                            n_workers=n_workers, 
+                            address=client_address) as client:
+        window = _count_dask_workers(client)
+        if client is not None:
+            window = 2 * window
+
+        num_asvs, asv_length = _check_read_lengths(rep_seq, 'rep_seq')
+        rep_seq = rep_seq.astype(str)
+
+        # Without mismatches, the alignment is a join on the sequence
+        if max_mismatch == 0:
+            align_fun = _align_kmers_exact
+            align_kws = {}
+            chunk_size = chunk_size * 100
+        elif method == 'pigeonhole':
+            align_fun = _align_kmers_pigeonhole
+            align_kws = {'seed_index': _build_seed_index(rep_seq, max_mismatch)}
         else:
-            aligned_batch.to_csv(str(ff), sep='\t', index=False, 
-                                 header=False,
-                                 mode='a')
+            align_fun = _align_kmers
+            align_kws = {}
+        if align_fun is not _align_kmers_exact:
+            align_kws['allowed_mismatch'] = max_mismatch
+            align_kws['block_size'] = \
+                _budget_block_size(memory_budget, asv_length, window)
+        align_kws['reads2'] = rep_seq
+
+        # Sends the ASVs (and seed index) to the workers once
+        if client is not None:
+            align_kws.update({
+                k: client.scatter(v, broadcast=True)
+                for k, v in align_kws.items() 
+                if isinstance(v, (pd.Series, pd.DataFrame))
+                })
+
+        def _kmer_batches():
+            for i, batch in enumerate(_chunks(kmers.view(DNAIterator), 
+                                              chunk_size)):
+                batch = pd.Series({s.metadata['id']: str(s) for s in batch})
+                if i == 0:
+                    num_kmers, kmer_length = _check_read_lengths(batch, 'kmer')
+                    if kmer_length != asv_length:
+                        raise ValueError('The kmer and ASV sequences must be the'
+                                         ' same length')
+                yield batch
+
+        # Performs the alignment, writing each block as it's finished
+        ff = KmerAlignFormat()
+        columns = ['kmer', 'asv', 'length', 'mismatch', 'region', 'max-mismatch']
+        with open(str(ff), 'w') as f_:
+            f_.write('%s\n' % '\t'.join(columns))
+            for aligned in _ordered_map(align_fun, _kmer_batches(), client, 
+                                        window, **align_kws):
+                aligned['region'] = region
+                aligned['max-mismatch'] = max_mismatch
+                aligned.to_csv(f_, sep='\t', index=False, header=False, 
+                               columns=columns)
 
-    return ff
+        return ff
+
+
+def _budget_block_size(memory_budget, length, window=1):
+    """
+    Finds the number of sequences per side of an alignment tile so that
+    `window` concurrent tiles fit in the memory budget
+
+    Parameters
+    ----------
+    memory_budget: int
+        The memory avaliable for the alignment, in megabytes
+    length: int
+        The length of the sequences being aligned
+    window: int, optional
+        The number of tiles which may be in memory at once
+
+    Returns
+    -------
+    int
+        The number of sequences per side of a tile
+    """
+    # Counting a tile holds about four packed copies of the pairwise words
+    pair_bytes = np.ceil(length / 16) * 8 * 4
+    block_size = np.sqrt(memory_budget * 1e6 / window / pair_bytes)
+    return int(max(1, np.floor(block_size)))
 
 
 def _align_kmers(reads1, reads2, allowed_mismatch=2, read1_label='kmer', 
     read2_label='asv', block_size=500):
     """
     Performs a kmer-based alignment between two groups of n-mers
+
+    The sequences are packed into one-hot nibbles (16 nt per uint64 word) 
+    and the mismatches are counted with XOR and popcount over 
+    `block_size` x `block_size` tiles, so each pair of tiles is handled in a
+    few array operations.
+
     Parameters
     ----------
-    reads1, reads2 : Dataframe
+    reads1, reads2 : Series
         The sequences to be aligned where the sequence identifer is given in
-        the index and each column contains a nucleotide.
-    mismatch : int, optional
+        the index and the value is the sequence as a string.
+    allowed_mismatch : int, optional
         The number of mismatches allowed between the two sets of sequences.
     read1_label, read2_label: str, optional
         A way to refer to the sequences in each alignment set
-    allow_degen1, allow_degen2 : bool, optional
-        Whether degeneracy should be allowed in the alignment. If 
-        `allow_degen1` and `allow_degen2`, then sequences
-    expand_match : bool, optional
-        If `allow_degen1 = True` and `allow_degen2 = True` then whether we
-        shoudl allow watches for degenerate positions that map to the same 
-        basepair. For example, when `expand_match == True` the ambigious 
-        nucleotide, "W" (A and T) could be matched to "N" (A, T, C, G) but 
-        not "S" (G, C).
+    block_size: int, optional
+        The number of sequences from each set compared in a single tile. 
+        The memory used by a tile scales with `block_size`^2 times the 
+        sequence length.
+
     Returns
     -------
     pd.DataFrame
@@ -147,23 +210,218 @@ def _align_kmers(reads1, reads2, allowed_mismatch=2, read1_label='kmer',
         If the two sets fo reads are of different lengths. (We can't align 
         kmers here that are different lengths).
     """
-    reads1 = reads1.apply(lambda x: np.array(list(x)))
-    reads2 = reads2.apply(lambda x: np.array(list(x)))
-    length = len(reads1.iloc[0])
-    match = pd.Series({
-        (id1, id2) : np.sum(seq1 == seq2)
-        for (id1, seq1), (id2, seq2) 
-        in it.product(reads1.items(), reads2.items())
-        })
-    match = length - match
-    match = match.loc[match <= allowed_mismatch]
-    match.index.set_names([read1_label, read2_label], inplace=True)
-    match.name = 'mismatch'
-    match = match.reset_index()
-    match['length'] = length
+    if (len(reads1) == 0) | (len(reads2) == 0):
+        return _format_matches(reads1, reads2, [], [], [], 0, read1_label, 
+                               read2_label)
+
+    length = _check_pair_length(reads1, reads2, read1_label, read2_label)
+    pos1, pos2, mismatch = _tile_matches(_pack_seqs(reads1.values), 
+                                         _pack_seqs(reads2.values),
+                                         allowed_mismatch=allowed_mismatch,
+                                         block_size=block_size,
+                                         )
+
+    return _format_matches(reads1, reads2, [pos1], [pos2], [mismatch], 
+                           length, read1_label, read2_label)
+
+
+def _align_kmers_pigeonhole(reads1, reads2, allowed_mismatch=2, 
+    read1_label='kmer', read2_label='asv', block_size=500, seed_index=None):
+    """
+    Performs a kmer-based alignment using a pigeonhole seed index
+
+    Each sequence is split into `allowed_mismatch + 1` segments. Any pair of
+    sequences with at most `allowed_mismatch` mismatches must share at least
+    one identical segment, so only the pairs which share a segment are 
+    counted.
+
+    Parameters
+    ----------
+    reads1, reads2 : Series
+        The sequences to be aligned where the sequence identifer is given in
+        the index and the value is the sequence as a string.
+    allowed_mismatch : int, optional
+        The number of mismatches allowed between the two sets of sequences.
+    read1_label, read2_label: str, optional
+        A way to refer to the sequences in each alignment set
+    block_size: int, optional
+        The candidate pairs are counted in groups of `block_size`^2 pairs
+    seed_index: DataFrame, optional
+        A pre-computed seed index for `reads2` from `_build_seed_index`. 
+        This lets the same index be reused for multiple sets of `reads1`.
+
+    Returns
+    -------
+    pd.DataFrame
+        A long-form dataframe giving the two read identifiers and the number
+        of nt that do not match.
+    """
+    if (len(reads1) == 0) | (len(reads2) == 0):
+        return _format_matches(reads1, reads2, [], [], [], 0, read1_label, 
+                               read2_label)
+
+    length = _check_pair_length(reads1, reads2, read1_label, read2_label)
+    if seed_index is None:
+        seed_index = _build_seed_index(reads2, allowed_mismatch)
+
+    # Finds the pairs that share at least one segment
+    candidates = _build_seed_index(reads1, allowed_mismatch).merge(
+        seed_index, 
+        on=['segment', 'seed'], 
+        suffixes=['1', '2'],
+        )
+    candidates = candidates[['pos1', 'pos2']].drop_duplicates()
+    cand1 = candidates['pos1'].values
+    cand2 = candidates['pos2'].values
+
+    # Counts the mismatches for the candidate pairs
+    seqs1 = _pack_seqs(reads1.values)
+    seqs2 = _pack_seqs(reads2.values)
+    step = block_size * block_size
+    mismatch = np.hstack([np.zeros(0, dtype=int)] + [
+        _count_set_nibbles(seqs1[cand1[i:(i + step)]] ^ 
+                           seqs2[cand2[i:(i + step)]])
+        for i in np.arange(0, len(cand1), step)
+        ])
+    keep = mismatch <= allowed_mismatch
+
+    return _format_matches(reads1, reads2, [cand1[keep]], [cand2[keep]], 
+                           [mismatch[keep]], length, read1_label, 
+                           read2_label)
+
+
+def _align_kmers_exact(reads1, reads2, read1_label='kmer', 
+    read2_label='asv'):
+    """
+    Finds the identical sequences between two groups of n-mers
+
+    This is the alignment with no allowed mismatches, performed as a single 
+    hash join on the sequence.
+
+    Parameters
+    ----------
+    reads1, reads2 : Series
+        The sequences to be aligned where the sequence identifer is given in
+        the index and the value is the sequence as a string.
+    read1_label, read2_label: str, optional
+        A way to refer to the sequences in each alignment set
+
+    Returns
+    -------
+    pd.DataFrame
+        A long-form dataframe giving the two read identifiers and the number
+        of nt that do not match.
+    """
+    if (len(reads1) == 0) | (len(reads2) == 0):
+        return _format_matches(reads1, reads2, [], [], [], 0, read1_label, 
+                               read2_label)
+
+    length = _check_pair_length(reads1, reads2, read1_label, read2_label)
+    matches = pd.DataFrame({'seq': reads1.values, 
+                            'pos': np.arange(0, len(reads1))}).merge(
+        pd.DataFrame({'seq': reads2.values, 
+                      'pos': np.arange(0, len(reads2))}),
+        on='seq',
+        suffixes=['1', '2'],
+        )
+
+    return _format_matches(reads1, reads2, 
+                           [matches['pos1'].values], 
+                           [matches['pos2'].values], 
+                           [np.zeros(len(matches), dtype=int)], 
+                           length, read1_label, read2_label)
+
+
+def _tile_matches(seqs1, seqs2, allowed_mismatch, block_size=500):
+    """
+    Finds the pairs of packed sequences within the allowed mismatch by
+    comparing `block_size` x `block_size` tiles
+
+    Returns
+    -------
+    ndarray
+        The position of the matched sequence in `seqs1`
+    ndarray
+        The position of the matched sequence in `seqs2`
+    ndarray
+        The number of mismatched nucleotides in the match
+    """
+    pos1, pos2, mismatch = [], [], []
+    for i in np.arange(0, len(seqs1), block_size):
+        tile1 = seqs1[i:(i + block_size)]
+        for j in np.arange(0, len(seqs2), block_size):
+            tile_miss = _packed_hamming(tile1, seqs2[j:(j + block_size)])
+            hit1, hit2 = np.nonzero(tile_miss <= allowed_mismatch)
+            pos1.append(hit1 + i)
+            pos2.append(hit2 + j)
+            mismatch.append(tile_miss[hit1, hit2])
+
+    return (np.hstack([np.zeros(0, dtype=int)] + pos1).astype(int), 
+            np.hstack([np.zeros(0, dtype=int)] + pos2).astype(int), 
+            np.hstack([np.zeros(0, dtype=int)] + mismatch).astype(int))
+
+
+def _build_seed_index(reads, allowed_mismatch):
+    """
+    Splits the reads into `allowed_mismatch + 1` segments for seeding
+
+    Parameters
+    ----------
+    reads: Series
+        The sequences to be indexed where the sequence identifer is given in
+        the index and the value is the sequence as a string.
+    allowed_mismatch : int
+        The number of mismatches allowed in the alignment
 
-    match[read1_label] = match[read1_label].astype(str)
-    match[read2_label] = match[read2_label].astype(str)
+    Returns
+    -------
+    DataFrame
+        The segment number (`segment`), the segment sequence (`seed`) and the
+        position of the read in `reads` (`pos`)
+    """
+    length = reads.str.len().max()
+    bounds = np.linspace(0, length, allowed_mismatch + 2).astype(int)
+    positions = np.arange(0, len(reads))
+    seeds = pd.concat(axis=0, ignore_index=True, objs=[
+        pd.DataFrame({'segment': i,
+                      'seed': reads.str.slice(start, stop).values,
+                      'pos': positions,
+                      })
+        for i, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:]))
+        ])
+    return seeds
+
+
+def _check_pair_length(reads1, reads2, read1_label, read2_label):
+    """
+    Checks that two sets of reads have one consistent length
+    """
+    length = np.unique(np.hstack([reads1.str.len(), reads2.str.len()]))
+    if len(length) > 1:
+        raise ValueError('The %s and %s sequences must be the same length'
+                         % (read1_label, read2_label))
+    return length[0]
+
+
+def _format_matches(reads1, reads2, pos1, pos2, mismatch, length, 
+    read1_label, read2_label):
+    """
+    Converts the positions of matched reads to a long-form alignment
+    """
+    pos1 = np.hstack([np.zeros(0, dtype=int)] + list(pos1)).astype(int)
+    pos2 = np.hstack([np.zeros(0, dtype=int)] + list(pos2)).astype(int)
+    mismatch = np.hstack([np.zeros(0, dtype=int)] + list(mismatch))
+
+    # Keeps the kmer-major order of the pairwise comparison
+    order = np.lexsort((pos2, pos1))
+    match = pd.DataFrame({
+        read1_label: reads1.index.values.astype(str)[pos1[order]],
+        read2_label: reads2.index.values.astype(str)[pos2[order]],
+        'length': length,
+        'mismatch': mismatch[order].astype(int),
+        })
+    match[[read1_label, read2_label]] = \
+        match[[read1_label, read2_label]].astype(object)
 
     return match[[read1_label, read2_label, 'length', 'mismatch']]
 
@@ -179,4 +437,4 @@ def _check_read_lengths(reads, read_label):
                           % read_label)
 
     return (length_dist.values[0], length_dist.index[0])
-    
+
@@ -13,6 +13,7 @@ from skbio import DNA
 from qiime2 import Metadata
 from q2_types.feature_data import (DNAFASTAFormat, DNAIterator)
 from q2_sidle._utils import (_setup_dask_client, 
+                             degenerate_map,
                              )
 from q2_feature_classifier._skl import _chunks
 
@@ -22,6 +23,12 @@ complement = {'A': 'T', 'T': 'A', 'G': 'C',  'C': 'G',
               'K': 'M', 'M': 'K', 'B': 'V', 'V': 'B',
               'D': 'H', 'H': 'D', 'N': 'N'}
 
+# The bases each degenerate nucleotide can take, indexed by the ASCII code
+degen_lookup = np.zeros(256, dtype=bool)
+degen_lookup[[ord(k) for k in degenerate_map]] = True
+degen_bases = {ord(k): np.array([ord(b) for b in v], dtype=np.uint8)
+               for k, v in degenerate_map.items()}
+
 
 def prepare_extracted_region(sequences: DNAFASTAFormat, 
     region:str, 
@@ -34,6 +41,7 @@ def prepare_extracted_region(sequences: DNAFASTAFormat,
     debug:bool=False, 
     n_workers:int=1,
     client_address:str=None,
+    cluster_config:str=None,
     ) -> (DNAFASTAFormat, pd.DataFrame):
     """
     Prepares and extracted database for regional alignment
@@ -59,6 +67,10 @@ def prepare_extracted_region(sequences: DNAFASTAFormat,
     n_workers: int, optional
         The number of jobs to initiate. When `n_workers` is 0, the cluster 
         will be able to access all avaliable resources.
+    cluster_config: str, optional
+        A YAML or JSON file describing the dask cluster (the `scheduler`, 
+        `n_workers`, `threads_per_worker`, `memory_limit` and `processes`).
+        This superceeds `n_workers` and `client_address`.
 
     Returns
     -------
@@ -71,31 +83,32 @@ def prepare_extracted_region(sequences: DNAFASTAFormat,
     """
 
     # Sets up the client
-    _setup_dask_client(debug=debug, cluster_config=None,  
-                       n_workers=n_workers, address=client_address)
-
-    # Reverse complements the reverse primer
-    if reverse_complement_rev:
-        rev_primer = str(DNA(rev_primer).reverse_complement())
-
-    # Reads in the sequences
-    sequences = sequences.view(DNAIterator)
-    seq_blocks = [dask.delayed(_block_seqs)(seq)
-                  for seq in _chunks(sequences, int((chunk_size)))]
-    # Makes the fake extraction position based on the trim length
-    fragment = [dask.delayed(_artifical_trim)(seq, trim_length) 
-                for seq in seq_blocks]
-    # Prepares the amplicon for collapsing
-    condensed = dd.from_delayed([
-        dask.delayed(_condense_seqs)(seq) for seq in fragment],
-        meta=[('amplicon', 'str'), ('seq-name', 'str')]
-    )
-    # Writes the 
-    ff, group2 = _collapse_all_sequences(condensed, reverse_complement_result)
-    ids = _expand_ids(group2, fwd_primer, rev_primer, region, trim_length,
-                      chunk_size)
-
-    return (ff, ids.compute().set_index('db-seq').sort_index())
+    with _setup_dask_client(debug=debug, cluster_config=cluster_config,
+                            n_workers=n_workers, address=client_address):
+
+        # Reverse complements the reverse primer
+        if reverse_complement_rev:
+            rev_primer = str(DNA(rev_primer).reverse_complement())
+
+        # Reads in the sequences
+        sequences = sequences.view(DNAIterator)
+        seq_blocks = [dask.delayed(_block_seqs)(seq)
+                      for seq in _chunks(sequences, int((chunk_size)))]
+        # Makes the fake extraction position based on the trim length
+        fragment = [dask.delayed(_artifical_trim)(seq, trim_length) 
+                    for seq in seq_blocks]
+        # Prepares the amplicon for collapsing
+        condensed = dd.from_delayed([
+            dask.delayed(_condense_seqs)(seq) for seq in fragment],
+            meta=[('amplicon', 'str'), ('seq-name', 'str')]
+        )
+        # Writes the 
+        ff, group2 = _collapse_all_sequences(condensed, reverse_complement_result)
+        ids = _expand_ids(group2, fwd_primer, rev_primer, region, trim_length)
+
+        ids.sort_values(['db-seq', 'seq-name', 'kmer'], inplace=True)
+
+        return (ff, ids.set_index('db-seq'))
 
 
 def _artifical_trim(seqs, trim_length):
@@ -122,12 +135,12 @@ def _block_seqs(seqs, degen_thresh=3):
     """
     Converts the sequences into an expanded sequence block
     """
-    s2 = pd.concat([_expand_degenerate_gen(seq, degen_thresh=degen_thresh) 
-                    for seq in seqs]).astype(str)
+    s2 = _expand_degenerate_block([seq.metadata['id'] for seq in seqs], 
+                                  [str(seq) for seq in seqs])
     s2.index.set_names('seq-name', inplace=True)
     s2.name = 'sequence'
     s3 = s2.reset_index()
-    s3['db-seq'] = s3['seq-name'].apply(lambda x: x.split("@")[0])
+    s3['db-seq'] = s3['seq-name'].str.split('@').str[0]
     return s3
 
 
@@ -166,25 +179,79 @@ def _condense_seqs(seqs):
     return fragment.sort_index().reset_index()
 
 
+def _expand_degenerate_block(ids, seqs):
+    """
+    Expands the degenerate sequences in a block of sequences
+
+    The degenerate positions are found for the whole block at once. All the
+    expansions of a degenerate sequence are then built together by 
+    indexing into the bases each position can take.
+
+    Parameters
+    ----------
+    ids : list of str
+        The sequence identifiers
+    seqs : list of str
+        The sequences
+
+    Returns
+    -------
+    Series
+        The expanded sequences. Sequences without degenerates keep their 
+        identifier; the sorted expansions of a degenerate sequence are 
+        labeled `id@0001`, `id@0002`, and so on.
+    """
+    lengths = np.array([len(seq_) for seq_ in seqs], dtype=int)
+    starts = np.cumsum(lengths) - lengths
+    bases = np.frombuffer(''.join(seqs).encode('ascii'), dtype=np.uint8)
+
+    # Groups the degenerate positions by the sequence they fall in
+    degen_pos = np.flatnonzero(degen_lookup[bases])
+    owner = np.searchsorted(starts, degen_pos, side='right') - 1
+    breaks = np.flatnonzero(np.diff(owner)) + 1
+    if len(degen_pos) > 0:
+        degen_pos = dict(zip(owner[np.r_[0, breaks]], 
+                             np.split(degen_pos, breaks)))
+    else:
+        degen_pos = {}
+
+    names = []
+    expanded = []
+    for i, (id_, seq_) in enumerate(zip(ids, seqs)):
+        if i not in degen_pos:
+            names.append(id_)
+            expanded.append(seq_)
+            continue
+        seq_bases = bases[starts[i]:(starts[i] + lengths[i])]
+        positions = degen_pos[i] - starts[i]
+        options = [degen_bases[b] for b in seq_bases[positions]]
+        num_expand = int(np.prod([len(o) for o in options]))
+
+        # Fills in the degenerate positions as the digits of the expansion 
+        # index
+        expand = np.tile(seq_bases, (num_expand, 1))
+        index = np.arange(0, num_expand)
+        stride = num_expand
+        for pos, option in zip(positions, options):
+            stride = stride // len(option)
+            expand[:, pos] = option[(index // stride) % len(option)]
+        expand = np.sort(expand.view('S%i' % lengths[i]).ravel())
+
+        names.extend('%s@%s' % (id_, str(j + 1).zfill(4)) 
+                     for j in np.arange(0, num_expand))
+        expanded.extend(expand.astype(str).tolist())
+
+    return pd.Series(expanded, index=names, dtype=object)
+
+
 def _expand_degenerate_gen(seq_, degen_thresh=3):
     """
     Expands the degenerate sequences in the seq blocks
     """
-    id_ = seq_.metadata['id']
-    if seq_.has_degenerates():
-        expand = pd.Series([s for s in seq_.expand_degenerates()]).astype(str)
-        expand.sort_values(inplace=True)
-        expand.reset_index(inplace=True, drop=True)
-        expand.rename(index={i: '%s@%s' % (id_, str(i + 1).zfill(4)) 
-                             for i in expand.index},
-                      inplace=True)
-    else:
-        expand = pd.Series({id_: seq_}).astype(str)
-    return expand
+    return _expand_degenerate_block([seq_.metadata['id']], [str(seq_)])
 
 
-def _expand_ids(group2, fwd_primer, rev_primer, region, trim_length, 
-    chunk_size):
+def _expand_ids(group2, fwd_primer, rev_primer, region, trim_length):
     """
     Expands the seq-name column from grouped IDs into an ID map to be used
     in alignment
@@ -201,8 +268,6 @@ def _expand_ids(group2, fwd_primer, rev_primer, region, trim_length,
         'kmer-based alignment.
     region : str
         The hypervariable region to profile.
-    chunk_size: int, optional
-        The number of sequences to group for analysis
 
     Returns
     -------
@@ -211,19 +276,9 @@ def _expand_ids(group2, fwd_primer, rev_primer, region, trim_length,
         sequence name, along with regional information
     """
 
-    # Collapses the data into grouped data
-
-    
     # Sorts out the ids
-    ids = dd.from_pandas(group2['seq-name'].apply(lambda x: x.strip('>')),
-                                                  chunksize=chunk_size)
-    ids.name = 'kmer'
-    ids = dd.from_delayed([dask.delayed(_split_ids)(seq_) 
-                          for seq_ in ids.to_delayed()],
-                          meta=[('kmer', str), ('seq-name', str)]
-                          )
-    ids['db-seq'] = ids['seq-name'].apply(lambda x: x.split("@")[0], 
-                                          meta=('db-seq', str))
+    ids = _split_ids(group2['seq-name'].str.strip('>').rename('kmer'))
+    ids['db-seq'] = ids['seq-name'].str.split('@').str[0]
     ids['fwd-primer'] = fwd_primer
     ids['rev-primer'] = rev_primer
     ids['region'] = region
@@ -236,9 +291,7 @@ def _split_ids(ids):
     """
     Splits collapsed kmers into single sequences for a database map
     """
-    kmers = pd.concat(axis=1, objs=[
-        ids, ids.apply(lambda x: pd.Series(x.split("|")))
-    ])
-    kmers = kmers.melt(id_vars='kmer', value_name='seq-name')
-    kmers.drop(columns=['variable'], inplace=True)
-    return kmers.dropna()
+    kmers = pd.DataFrame({'kmer': ids.values, 
+                          'seq-name': ids.str.split('|').values})
+    kmers = kmers.explode('seq-name')
+    return kmers.dropna().reset_index(drop=True)
@@ -1,7 +1,6 @@
 import dask
 import dask.dataframe as dd
 import numpy as np
-import regex
 import pandas as pd
 from skbio import DNA
 
@@ -10,6 +9,8 @@ from q2_sidle._utils import (_setup_dask_client,
                              _convert_generator_to_seq_block, 
                              _convert_seq_block_to_dna_fasta_format,
                              _count_degenerates,
+                             _count_packed_degenerates,
+                             _pack_seqs,
                              database_params,
                              )
 from q2_types.feature_data import (DNAFASTAFormat,
@@ -64,10 +65,11 @@ def filter_degenerate_sequences(sequences: DNASequencesDirectoryFormat,
     sequences.columns = ['id', 'sequence']
     sequences['sequence'] = sequences['sequence'].astype(str)
     def _count_degen(x):
-        return len(regex.findall('[RYSWKMBDHVN]', x)) <= max_degen
+        num_degen = _count_packed_degenerates(_pack_seqs(x.values))
+        return pd.Series(num_degen <= max_degen, index=x.index)
 
-    sequences['count'] = sequences['sequence'].apply(_count_degen, 
-                                                     meta=('sequence', bool))
+    sequences['count'] = sequences['sequence'].map_partitions(
+        _count_degen, meta=('sequence', bool))
     sequences = sequences.loc[sequences['count']]
 
     sequences['skbio'] = \
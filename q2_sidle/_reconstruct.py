@@ -1,4 +1,3 @@
-import copy
 import itertools as it
 import os
 import warnings
@@ -9,6 +8,8 @@ import dask
 import dask.dataframe as dd
 import numpy as np
 import pandas as pd
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components
 
 from qiime2 import Metadata, Artifact
 from qiime2.plugin import ValidationError
@@ -21,15 +22,21 @@ def reconstruct_counts(
     regional_alignment: pd.DataFrame,
     kmer_map: pd.DataFrame,
     regional_table: biom.Table,
+    warm_start: biom.Table=None,
     count_degenerates: bool=True,
     per_nucleotide_error: float=0.005,
     min_abund: float=1e-5,
     region_normalize: str='average',
     block_size : int=10000,
     min_counts: int=1000,
+    solver: str='em',
+    tolerance: float=1e-7,
+    num_iter: int=100000,
+    sample_batch: int=None,
     debug: bool=False, 
     n_workers: int=1,
     client_address: str=None,
+    cluster_config: str=None,
     ) -> (biom.Table, Metadata, pd.DataFrame):
     """
     Reconstructs regional alignments into a full length 16s sequence
@@ -37,6 +44,12 @@ def reconstruct_counts(
     Parameters
     ----------
     # region: 
+    warm_start: biom.Table, optional
+        A table reconstructed from an earlier run on the same samples. The
+        solution for each sample in the table is used as its starting point,
+        so samples which are mostly unchanged converge in a few iterations.
+        Reference sequences which are new in this run or which the earlier
+        run assigned no abundance to start from the alignment.
     count_degenerates: bool
         Whether degenerate sequences should be counted as unique kmers during
         reconstruction or only unique sequences should be counted.
@@ -58,6 +71,26 @@ def reconstruct_counts(
         "weight" will give a total count of 2000. "unweighted" will ignore
         the regional normalization in the abundance calculation and is preferable
         for meta analysis.
+    min_counts: int
+        The minimum number of counts for a sample to be reconstructed
+    solver: str ('em', 'squarem')
+        The update used to solve the relative abundance. "em" is the SMURF
+        expectation maximization update. "squarem" uses squared 
+        extrapolation between EM updates, which converges to the same fixed
+        point within `tolerance` in fewer updates. The number of updates 
+        used per sample is printed.
+    tolerance: float
+        The total change in the reference frequencies between EM updates
+        below which a sample is considered converged. A larger tolerance
+        trades accuracy for speed.
+    num_iter: int
+        The maximum number of EM updates per sample. Samples which have not
+        converged by then are reported in a warning.
+    sample_batch: int, optional
+        The number of samples to solve and scale together. Only one batch 
+        of relative abundances and intermediate results is held at a time,
+        so memory is governed by the batch size rather than the total
+        number of samples. By default, all samples are solved together.
     debug: bool
         Whether the function should be run in debug mode (without a client)
         or not. `debug` superceeds all options
@@ -66,6 +99,10 @@ def reconstruct_counts(
         will be able to access all avalaibel resources.
     client_address: str
         The IP address for an existing dask client/cluster
+    cluster_config: str, optional
+        A YAML or JSON file describing the dask cluster (the `scheduler`, 
+        `n_workers`, `threads_per_worker`, `memory_limit` and `processes`).
+        This superceeds `n_workers` and `client_address`.
 
     Returns
     -------
@@ -83,167 +120,273 @@ def reconstruct_counts(
     """
     
     # Sets up the client
-    _setup_dask_client(debug=debug, cluster_config=None,  
-                       n_workers=n_workers, address=client_address)
-
-    region, region_idx = np.unique(region, return_index=True)
-    region_order = {region: i for (i, region) in zip(*(region_idx, region))}
-    region_names = {i: r for r, i in region_order.items()}
-    num_regions = len(region_order)
-
-    # Imports the alignment maps and gets the kmers that were aligned
-    align_map = pd.concat(
-        axis=0, 
-        sort=False, 
-        objs=regional_alignment)
-    align_map.drop_duplicates(['asv', 'kmer'], inplace=True)
-    align_map.replace({'region': region_order}, inplace=True)
-    aligned_kmers = _get_unique_kmers(align_map['kmer'])
-
-    print('Regional Alignments Loaded')
-
-    # ### Untangles the database to get the unique regional mapping
-
-    # Filters database down to kmers which are present in the sequences 
-    # because otherwise we're trying to untangle a huge amount of data and it 
-    # just gets memory intensive and slow
-    kmer_map = pd.concat(
-        axis=0,
-        objs=kmer_map,
-    )
-    kmer_map['region'] = kmer_map['region'].replace(region_order) 
+    with _setup_dask_client(debug=debug, cluster_config=cluster_config,
+                            n_workers=n_workers, address=client_address):
+
+        region, region_idx = np.unique(region, return_index=True)
+        region_order = {region: i for (i, region) in zip(*(region_idx, region))}
+        region_names = {i: r for r, i in region_order.items()}
+        num_regions = len(region_order)
+
+        # Imports the alignment maps and gets the kmers that were aligned
+        align_map = pd.concat(
+            axis=0, 
+            sort=False, 
+            objs=regional_alignment)
+        align_map.drop_duplicates(['asv', 'kmer'], inplace=True)
+        align_map.replace({'region': region_order}, inplace=True)
+        aligned_kmers = _get_unique_kmers(align_map['kmer'])
+
+        print('Regional Alignments Loaded')
+
+        # ### Untangles the database to get the unique regional mapping
+
+        # Filters database down to kmers which are present in the sequences 
+        # because otherwise we're trying to untangle a huge amount of data and it 
+        # just gets memory intensive and slow
+        kmer_map = pd.concat(
+            axis=0,
+            objs=kmer_map,
+        )
+        kmer_map['region'] = kmer_map['region'].replace(region_order) 
 
-    kmers =_get_unique_kmers(kmer_map.loc[aligned_kmers, 'kmer'])
+        kmers =_get_unique_kmers(kmer_map.loc[aligned_kmers, 'kmer'])
 
-    kmer_map = kmer_map.loc[kmers]
-    kmer_map.reset_index(inplace=True)
-    kmer_map.drop_duplicates(inplace=True)
-    kmer_map.set_index('db-seq', inplace=True)
+        kmer_map = kmer_map.loc[kmers]
+        kmer_map.reset_index(inplace=True)
+        kmer_map.drop_duplicates(inplace=True)
+        kmer_map.set_index('db-seq', inplace=True)
 
-    print('Regional Kmers Loaded')
+        print('Regional Kmers Loaded')
 
-    # Builds database mapping bettween the kmer, the original database
-    # sequence and the original name
-    db_map = _untangle_database_ids(
-        kmer_map.reset_index(),
-        num_regions=num_regions,
-        )
-    print('Database map assembled')
+        # Builds database mapping bettween the kmer, the original database
+        # sequence and the original name
+        db_map = _untangle_database_ids(
+            kmer_map.reset_index(),
+            num_regions=num_regions,
+            )
+        print('Database map assembled')
+
+        ### Summarizes the database 
+        kmer_map['clean_name'] = db_map
+        kmer_map.reset_index(inplace=True)
+
+
+        db_summary = _count_mapping(kmer_map.reset_index(), 
+                                    count_degenerates, 
+                                    kmer='seq-name')
+        if region_normalize == 'unweighted':
+            db_summary['num-regions'] = 1
+
+        print('Database map summarized')
+
+        ### Constructs the regional alignment
+        align_mat = _construct_align_mat(align_map,
+                                        sequence_map=db_map.to_dict(),
+                                        seq_summary=db_summary,
+                                        nucleotide_error=per_nucleotide_error, 
+                                        blocksize=block_size,
+                                        )
+        print('Alignment map constructed')
+
+        ### Solves the relative abundance
+        counts = regional_table[0]
+        if len(regional_table) > 1:
+            for table_ in regional_table[1:]:
+                counts = counts.merge(table_)
+
+        # We have to account for the fact that some of hte ASVs may have been 
+        # discarded because they didn't meet the match parameters we've set or 
+        # because they're not in the database. The table stays sparse; we
+        # only ever look at the ids and the per-axis sums.
+        aligned = align_mat['asv'].unique()
+        keep_asvs = counts.ids(axis='observation')
+        keep_asvs = keep_asvs[pd.Index(keep_asvs).isin(aligned)]
+        counts = counts.filter(keep_asvs, axis='observation', inplace=False)
+        keep_samples = counts.sum(axis='sample') > min_counts
+        if keep_samples.sum() == 0:
+            raise ValueError('None of the samples have more than the %i total '
+                             'sequences required for reconstruction.' 
+                             % min_counts)
+        elif not keep_samples.all():
+            warnings.warn("There are %i samples with fewer than %i total"
+                          " reads. These samples will be discarded."
+                          % ((keep_samples==False).sum(), min_counts),
+                          UserWarning)
+        counts = counts.filter(counts.ids(axis='sample')[keep_samples], 
+                               axis='sample', inplace=False)
+        keep_asvs = \
+            counts.ids(axis='observation')[counts.sum(axis='observation') > 0]
+        counts = counts.filter(keep_asvs, axis='observation', inplace=False)
+
+        align_mat = align_mat.loc[align_mat['asv'].isin(keep_asvs)]
+        keep_kmers = align_mat['clean_name'].unique()
+        db_summary = db_summary.loc[keep_kmers]
+
+        print('counts loaded')
+
+        # Performs the maximum liklihood reconstruction and scales the 
+        # relative abundance back to counts one partition of samples at a 
+        # time. Only the scaled counts are kept from each partition, so the 
+        # normalized table and relative abundance for the full set of 
+        # samples are never held together.
+        sample_ids = counts.ids(axis='sample')
+        if sample_batch is None:
+            sample_batch = len(sample_ids)
+        count_table = []
+        for start in np.arange(0, len(sample_ids), sample_batch):
+            batch = counts.filter(sample_ids[start:(start + sample_batch)],
+                                  axis='sample', inplace=False)
+            batch.remove_empty(axis='observation', inplace=True)
+            rel_abund = _solve_iterative_noisy(
+                align_mat=align_mat, 
+                table=batch.norm(axis='sample', inplace=False),
+                min_abund=min_abund,
+                seq_summary=db_summary,
+                tolerance=tolerance,
+                num_iter=num_iter,
+                solver=solver,
+                prior=warm_start,
+                )
+            print('Relative abundance calculated')
+
+            # Puts together the regional normalized counts
+            batch = _scale_relative_abundance(
+                align_mat=align_mat,
+                relative=rel_abund,
+                counts=batch,
+                region_normalize=region_normalize,
+                num_regions=num_regions,
+                seq_summary=db_summary.loc[rel_abund.ids(axis='observation')],
+                )
+            count_table.append(batch)
+        if len(count_table) > 1:
+            print('%i sample batches reconstructed' % len(count_table))
+        count_table = _concat_samples(count_table)
+        count_table = count_table.filter(lambda v, id_,  md: v.sum() > 0,  
+                                         axis='observation')
+
+        summary = db_summary.loc[count_table.ids(axis='observation')]
+        summary['mapped-asvs'] = \
+            align_mat.groupby('clean_name')['asv'].apply(lambda x: '|'.join(x))
+        summary.index.set_names('feature-id', inplace=True)
+        summary = Metadata(summary)
+
+        # Puts together a kmer-based mapping which describes the regions covered
+        kmer_map.sort_values(['db-seq', 'region'], ascending=True, inplace=True)
+        kmer_map.drop_duplicates(['db-seq', 'region'], inplace=True)
+        kmer_map['region'] = kmer_map['region'].astype(int)
+
+        first_fwd = kmer_map.drop_duplicates('db-seq', keep='first')
+        first_fwd = first_fwd.set_index('db-seq')[['fwd-primer']]
+        last_rev = kmer_map.drop_duplicates('db-seq', keep='last')
+        last_rev = last_rev.set_index('db-seq')[['fwd-primer', 'kmer-length']]
+
+        mapping = pd.concat(axis=1, sort=False, objs=[
+            db_map[db_map.isin(count_table.ids(axis='observation'))],
+            first_fwd.add_prefix('first-'),
+            last_rev.add_prefix('last-'),
+            ])
+        mapping.index.set_names('db-seq', inplace=True)
+        mapping.dropna(subset=['clean_name'], inplace=True)
+        mapping.sort_index(inplace=True)
+
+        return count_table, summary, mapping
+
+
+def _build_sparse_align(align_mat, asvs, seqs, seq_name='clean_name', 
+    asv_name='asv', value='norm'):
+    """
+    Builds a sparse alignment matrix from the long-form alignment
 
-    ### Summarizes the database 
-    kmer_map['clean_name'] = db_map
-    kmer_map.reset_index(inplace=True)
+    Parameters
+    ----------
+    align_mat: DataFrame
+        The long-form alignment from `_construct_align_mat`
+    asvs, seqs: array-like
+        The ASV and reference sequence identifiers in the order they should
+        appear in the rows and columns of the matrix. Alignments to any other
+        ASV or reference are ignored.
+    seq_name, asv_name: str, optional
+        The columns in `align_mat` identifying the reference sequence and 
+        ASV
+    value: str, optional
+        The column in `align_mat` with the matrix values. Repeated pairs
+        are averaged.
 
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        The (ASV x reference) alignment matrix
+    """
+    pairs = align_mat.groupby([asv_name, seq_name])[value].mean()
+    rows = pd.Index(asvs).get_indexer(pairs.index.get_level_values(0))
+    cols = pd.Index(seqs).get_indexer(pairs.index.get_level_values(1))
+    keep = (rows >= 0) & (cols >= 0)
+
+    return scipy.sparse.csr_matrix(
+        (pairs.values[keep], (rows[keep], cols[keep])),
+        shape=(len(asvs), len(seqs)),
+        )
 
-    db_summary = _count_mapping(kmer_map.reset_index(), 
-                                count_degenerates, 
-                                kmer='seq-name')
-    if region_normalize == 'unweighted':
-        db_summary['num-regions'] = 1
 
-    print('Database map summarized')
+def _concat_samples(tables):
+    """
+    Combines tables which describe different samples into a single table
 
-    ### Constructs the regional alignment
-    align_mat = _construct_align_mat(align_map,
-                                    sequence_map=db_map.to_dict(),
-                                    seq_summary=db_summary,
-                                    nucleotide_error=per_nucleotide_error, 
-                                    blocksize=block_size,
-                                    )
-    print('Alignment map constructed')
-    
-    ### Solves the relative abundance
-    counts = regional_table[0]
-    if len(regional_table) > 1:
-        for table_ in regional_table[1:]:
-            counts = counts.merge(table_)
+    Rather than re-indexing the observations of each table in a pairwise
+    concatenation, the observations are collected once and the data from
+    each table is written into a single preallocated sparse matrix.
 
-    counts = pd.DataFrame(
-        counts.matrix_data.toarray(),
-        index=counts.ids(axis='observation'),
-        columns=counts.ids(axis='sample'),
-    )
-    counts.fillna(0, inplace=True)
-
-    # We have to account for the fact that some of hte ASVs may have been 
-    # discarded because they didn't meet the match parameters we've set or 
-    # because they're not in the database.
-    keep_asvs = list(set(align_mat['asv'].values) & (set(counts.index)))
-    unaligned_counts = counts.copy().drop(keep_asvs).sum(axis=1)
-    counts = counts.loc[keep_asvs]
-    keep_samples = counts.sum(axis=0) > min_counts
-    if keep_samples.sum() == 0:
-        raise ValueError('None of the samples have more than the %i total '
-                         'sequences required for reconstruction.' 
-                         % min_counts)
-    elif not keep_samples.all():
-        warnings.warn("There are %i samples with fewer than %i total"
-                      " reads. These samples will be discarded."
-                      % ((keep_samples==False).sum(), min_counts),
-                      UserWarning)
-    counts = counts[keep_samples.index.values[keep_samples.values]]
-    counts = counts.loc[counts.sum(axis=1) > 0]
-    keep_asvs = counts.index
-
-
-    align_mat = align_mat.loc[align_mat['asv'].isin(keep_asvs)]
-    keep_kmers = align_mat['clean_name'].unique()
-    db_summary = db_summary.loc[keep_kmers]
-
-    # Normalizes the alignment table
-    n_table = counts / counts.sum(axis=0)
-    print('counts loaded')
-
-    # Performs the maximum liklihood reconstruction on a per-sample basis. 
-    # Im not sure if this could be refined to optimize the alogirthm
-    # to allow multiple samples ot be solved together, but... eh?
-    sample_ids = n_table.columns.values
-    n_samples = len(sample_ids)
-    # print('start normalization')
-
-    rel_abund = _solve_iterative_noisy(align_mat=align_mat, 
-                                       table=n_table,
-                                       min_abund=min_abund,
-                                       seq_summary=db_summary)
-    db_summary = db_summary.loc[rel_abund.ids(axis='observation')]
-    print('Relative abundance calculated')
-
-    # Puts together the regional normalized counts
-    count_table = _scale_relative_abundance(align_mat=align_mat,
-                                            relative=rel_abund,
-                                            counts=counts,
-                                            region_normalize=region_normalize,
-                                            num_regions=num_regions,
-                                            seq_summary=db_summary)
-    count_table = count_table.filter(lambda v, id_,  md: v.sum() > 0,  
-                                     axis='observation')
-
-    summary = db_summary.loc[count_table.ids(axis='observation')]
-    summary['mapped-asvs'] = \
-        align_mat.groupby('clean_name')['asv'].apply(lambda x: '|'.join(x))
-    summary.index.set_names('feature-id', inplace=True)
-    summary = Metadata(summary)
-
-    # Puts together a kmer-based mapping which describes the regions covered
-    kmer_map.sort_values(['db-seq', 'region'], ascending=True, inplace=True)
-    kmer_map.drop_duplicates(['db-seq', 'region'], inplace=True)
-    kmer_map['region'] = kmer_map['region'].astype(int)
-
-    first_fwd = kmer_map.drop_duplicates('db-seq', keep='first')
-    first_fwd = first_fwd.set_index('db-seq')[['fwd-primer']]
-    last_rev = kmer_map.drop_duplicates('db-seq', keep='last')
-    last_rev = last_rev.set_index('db-seq')[['fwd-primer', 'kmer-length']]
-    
-    mapping = pd.concat(axis=1, sort=False, objs=[
-        db_map[db_map.isin(count_table.ids(axis='observation'))],
-        first_fwd.add_prefix('first-'),
-        last_rev.add_prefix('last-'),
-        ])
-    mapping.index.set_names('db-seq', inplace=True)
-    mapping.dropna(subset=['clean_name'], inplace=True)
-    mapping.sort_index(inplace=True)
+    Parameters
+    ----------
+    tables : list of biom.Table
+        The tables to combine. Each sample should be in only one table.
 
-    return count_table, summary, mapping
+    Returns
+    -------
+    biom.Table
+        The combined table. The observations are the sorted union of those
+        in `tables`, with any observation metadata carried over.
+    """
+    tables = list(tables)
+    if len(tables) == 1:
+        return tables[0]
+
+    obs_ids = pd.Index(np.unique(np.hstack([
+        table.ids(axis='observation') for table in tables
+    ])))
+    sample_ids = np.hstack([table.ids(axis='sample') for table in tables])
+
+    nnz = np.sum([table.matrix_data.nnz for table in tables])
+    rows = np.empty(nnz, dtype=np.int64)
+    cols = np.empty(nnz, dtype=np.int64)
+    data = np.empty(nnz, dtype=float)
+    obs_md = {}
+    start = 0
+    offset = 0
+    for table in tables:
+        block = table.matrix_data.tocoo()
+        stop = start + block.nnz
+        obs_pos = obs_ids.get_indexer(table.ids(axis='observation'))
+        rows[start:stop] = obs_pos[block.row]
+        cols[start:stop] = block.col + offset
+        data[start:stop] = block.data
+        start = stop
+        offset += block.shape[1]
+        if table.metadata(axis='observation') is not None:
+            obs_md.update(zip(table.ids(axis='observation'), 
+                              table.metadata(axis='observation')))
+
+    matrix = scipy.sparse.csr_matrix((data, (rows, cols)), 
+                                     shape=(len(obs_ids), len(sample_ids)))
+    combined = biom.Table(matrix, 
+                          observation_ids=obs_ids.values, 
+                          sample_ids=sample_ids)
+    if obs_md:
+        combined.add_metadata(obs_md, axis='observation')
+
+    return combined
 
 
 def _construct_align_mat(match, sequence_map, seq_summary, 
@@ -284,21 +427,41 @@ def _construct_align_mat(match, sequence_map, seq_summary,
 
     """
 
-    # Expands the kmer identifiers and then maps back to the database
-    align_mat = dd.from_pandas(
-        _expand_duplicate_sequences(match, id_col=kmer_name),
-        chunksize=blocksize
-    )
-
-    align_mat['db-seq'] = \
-        align_mat[kmer_name].apply(lambda x: x.split('@')[0],
-                                   meta=('kmer_name', 'str'))
-    align_mat[seq_name] = align_mat['db-seq'].replace(sequence_map)
+    # Interns the kmer, database sequence and ASV identifiers as integer 
+    # codes, so each kmer name is split and mapped back to the database 
+    # once rather than once per alignment
+    kmer_codes, kmer_ids = pd.factorize(match[kmer_name])
+    kmer_seqs = _expand_duplicate_sequences(
+        pd.DataFrame({kmer_name: kmer_ids, 
+                      'kmer-code': np.arange(0, len(kmer_ids))}),
+        id_col=kmer_name,
+        )
+    db_seqs = kmer_seqs[kmer_name].str.split('@').str[0]
+    clean_names = db_seqs.map(pd.Series(sequence_map)).fillna(db_seqs)
+    kmer_seqs['seq-code'], seq_ids = pd.factorize(clean_names, sort=True)
+    asv_codes, asv_ids = pd.factorize(match[asv_name], sort=True)
+
+    align_mat = pd.DataFrame({
+        'kmer-code': kmer_codes,
+        'asv-code': asv_codes,
+        'region': match['region'].values,
+        'max-mismatch': match['max-mismatch'].values,
+        miss_col: match[miss_col].values,
+        'length': match['length'].values,
+        })
+    align_mat = align_mat.merge(kmer_seqs[['kmer-code', 'seq-code']], 
+                                on='kmer-code')
+    align_mat = dd.from_pandas(align_mat, chunksize=blocksize)
 
     # Collapses into ASV-ref seq combos where for degenerates, the closet
     # match is retained as the sequence.
-    asv_ref = align_mat.groupby([seq_name, asv_name, 'region', 'max-mismatch'])
-    asv_ref = asv_ref[[miss_col, 'length']].min().reset_index()
+    asv_ref = align_mat.groupby(['seq-code', 'asv-code', 'region', 
+                                 'max-mismatch'])
+    asv_ref = asv_ref[[miss_col, 'length']].min().compute().sort_index()
+    asv_ref.reset_index(inplace=True)
+    asv_ref.insert(0, seq_name, seq_ids[asv_ref['seq-code'].values])
+    asv_ref.insert(1, asv_name, asv_ids[asv_ref['asv-code'].values])
+    asv_ref.drop(columns=['seq-code', 'asv-code'], inplace=True)
 
     ## E(ih) : Pr(read = i | kmer = h)
     # Calculates the probability of an error as the probability that bases
@@ -334,7 +497,7 @@ def _construct_align_mat(match, sequence_map, seq_summary,
 
     asv_ref['norm'] = (asv_ref['match_prob'] / asv_ref['region-norm'])
 
-    asv_ref  = asv_ref.reset_index().compute()
+    asv_ref  = asv_ref.reset_index()
     asv_ref.drop(columns='region-norm', inplace=True)
 
     return asv_ref
@@ -376,6 +539,40 @@ def _count_mapping(long_, count_degen, kmer='kmer', region='region',
     return counts
 
 
+def _densify_prior(prior, rows, present, scale):
+    """
+    Converts a block of an earlier reconstruction into a starting frequency
+
+    Parameters
+    ----------
+    prior: scipy.sparse.spmatrix
+        The (reference x sample) relative abundance from the earlier 
+        reconstruction for the samples in the block which it covers
+    rows: ndarray
+        The row in `prior` for each reference in the alignment, or -1 if the 
+        reference wasn't in the earlier reconstruction
+    present: ndarray
+        Whether each sample was in the earlier reconstruction
+    scale: ndarray
+        The number of regions for each reference in the alignment, which 
+        undoes the region normalization
+
+    Returns
+    -------
+    ndarray
+        The (reference x sample) starting frequency, where references and 
+        samples missing from the earlier reconstruction are `nan`
+    """
+    has_row = rows >= 0
+    freq = np.full((len(rows), len(present)), np.nan)
+    freq[np.ix_(has_row, present)] = \
+        prior[rows[has_row]].toarray() * scale[has_row, None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        freq = freq / np.nansum(freq, axis=0)
+
+    return freq
+
+
 def _detangle_names(long_):
     """
     Splits up the mapping into clearer clusters
@@ -383,10 +580,8 @@ def _detangle_names(long_):
     Parameters
     ----------
     long_: DataFrame
-        A mapping between the database sequence (`db-seq`), the matched 
-        sequence  (`clean_name`), and a column (`counter`) containing an 
-        integer describing how many sequences are mapped to the 
-        database sequence in a sorted order.
+        A mapping between the database sequence (`db-seq`) and the matched 
+        sequence  (`clean_name`), with one row per connected pair.
         It is important that this be a long, defense association: condensed/
         upper triangle matrices will not work here.
 
@@ -396,71 +591,64 @@ def _detangle_names(long_):
         A mapping between the databset sequence and a unique group name.
     """
 
-    long_.sort_values(['db-seq', 'clean_name'], ascending=True, inplace=True)
-    long_['counter'] = 1
-    long_['counter'] = long_.groupby(['db-seq'])['counter'].cumsum() - 1
-    
-    # gets the horizontal mapping that pivots the dataframe into a square
-    # distance/mapping matrix
-    map_ = \
-        long_.set_index(['db-seq', 'clean_name'])['counter'].unstack().notna()
-    diagnonal = (np.tril(np.ones(map_.shape)) == np.triu(np.ones(map_.shape)))
-    map_ = (map_ | diagnonal)
-    
-    # Clusters the sequences
-    map_.sort_values(list(map_.columns), inplace=True)
-    map_ = map_[map_.index]
-        
-    # Calculates the number of connections within the cluster
-    num_connections = (long_.groupby('db-seq')['counter'].max() + 1)
-    long_.set_index('clean_name', inplace=True)
-    long_['co-connection'] = num_connections[long_.index]
-    co_min = long_.groupby('db-seq')['co-connection'].min()
+    long_ = long_[['db-seq', 'clean_name']]
+
+    # Calculates the number of connections for each sequence, and the 
+    # fewest connections among the sequences it is connected to
+    num_connections = long_.groupby('db-seq').size()
+    co_min = num_connections.loc[long_['clean_name'].values].groupby(
+        long_['db-seq'].values).min()
     connection_penalty = (num_connections - co_min + 1)
 
-    # Builds a mask that penalizes for the number of connections that should
-    # be present
-    penalty_v = (np.ones((len(connection_penalty), 1)) * 
-                 connection_penalty.loc[map_.index].values)
-    penalty_mask = (penalty_v == penalty_v.T)
-    
-    overlap = penalty_mask & map_
-    overlap = overlap.mask(~overlap, np.nan)
-    overlap = overlap.unstack().dropna().reset_index()
-
-    # # In some cases, there are sequences that have the same number of 
-    # # connections but don't  connect to the same sequences. So,for pairs 
-    # # of unique sequences which are initally mapped, we want to check the
-    # # number of sequences that overlap
-    shared = \
-        overlap.groupby('db-seq')['clean_name'].apply(lambda x: set(x.values))
-    def check_shared(x):
-        seqs0 = shared.loc[x['clean_name']]
-        seqs1 = shared.loc[x['db-seq']]
-        if len(seqs0) != len(seqs1):
-            return 0
-        else:
-            return len(seqs0 & seqs1) - 1
-
-    check_diff = overlap['clean_name'] != overlap['db-seq']
-
-    if check_diff.any():
-        overlap['seq_count'] = overlap.loc[check_diff].apply(check_shared, axis=1)
-    else:
-        overlap['seq_count'] = np.nan
-    overlap['matches'] = (overlap['seq_count'] == overlap[0]) | ~check_diff
+    # Keeps the connections (and each sequence's connection to itself) 
+    # between sequences with the same connection penalty
+    overlap = pd.concat(axis=0, ignore_index=True, objs=[
+        long_,
+        pd.DataFrame({'db-seq': connection_penalty.index.values, 
+                      'clean_name': connection_penalty.index.values}),
+        ])
+    overlap.drop_duplicates(inplace=True)
+    same_penalty = (
+        connection_penalty.loc[overlap['db-seq'].values].values == 
+        connection_penalty.loc[overlap['clean_name'].values].values
+        )
+    overlap = overlap.loc[same_penalty]
 
     overlap.sort_values(['db-seq', 'clean_name'], 
                         inplace=True, 
                         ascending=True)
-    overlap.drop_duplicates(['db-seq', 'clean_name'], 
-                            inplace=True)
     new_name = \
         overlap.groupby('db-seq')['clean_name'].apply(lambda x: "|".join(x))
 
     return new_name
 
 
+def _em_update(align, align_t, freq, abund):
+    """
+    Performs a single SMURF EM update for a set of samples
+
+    Returns
+    -------
+    ndarray
+        The updated (reference x sample) frequency
+    ndarray
+        The error for each sample
+    """
+    ### Expectation
+    # assign theta estimate for each bacteria
+    theta_i = align @ freq
+
+    ### Maximization
+    # Adjusts the abundance and bacterial frequency
+    r_weighted = abund / (theta_i + np.spacing(1))
+    bact_factor = align_t @ r_weighted
+
+    # Computes the error per sample
+    error = (np.absolute(1 - bact_factor) * freq).sum(axis=0)
+
+    return freq * bact_factor, error
+
+
 def _expand_duplicate_sequences(df, id_col, delim='|'):
     """
     Expands delimited IDs into rows with unique identifiers
@@ -482,49 +670,116 @@ def _expand_duplicate_sequences(df, id_col, delim='|'):
         An expanded dataframe.
     """
     data_cols = df.drop(columns=[id_col]).columns
-    wide_exp = pd.concat(axis=1, objs=[
-        df[id_col].apply(lambda x: pd.Series(x.split(delim))),
-        df[data_cols]
-        ])
-    # Converts to long form and drops the duplicated anything without an ID
-    long_exp = wide_exp.melt(
-        id_vars=data_cols,
-        value_vars=wide_exp.drop(columns=data_cols).columns,
-        value_name=id_col
-    ).drop(columns=['variable']).dropna(subset=[id_col])
-    long_exp = long_exp[np.hstack([[id_col], data_cols.values])]
+    long_exp = df[data_cols].copy()
+    long_exp.insert(0, id_col, df[id_col].str.split(delim))
+    # Converts to long form and drops anything without an ID
+    long_exp = long_exp.explode(id_col)
+    long_exp.dropna(subset=[id_col], inplace=True)
     long_exp.sort_values(by=list(long_exp.columns), inplace=True)
     long_exp.reset_index(inplace=True, drop=True)
 
     return long_exp
 
 
-def _get_clean(df):
-    clean_kmers = \
-        df.groupby(['db-seq', 'region'])['value'].apply(
-            lambda x: "|".join(x.values))
-    return clean_kmers.reset_index()
-
-
 def _get_shared_seqs(df):
-    wide = df.set_index(['db-seq', 'region'])['kmer'].apply(
-            lambda x: pd.Series(x.split("|"))).reset_index()
-    long_ = wide.melt(id_vars=['db-seq', 'region']).dropna()
-    long_['value'] = long_['value'].apply(lambda x: x.split("@")[0])
-    db_seqs = long_['db-seq'].unique()
-    matched = long_['value'].unique()
-    long_.replace({'value': {x: 'X' for x in matched if (x not in db_seqs)}},
-                  inplace=True)
+    """
+    Gets the database sequences which share a kmer with each database
+    sequence in each region. Sequences outside the database are labeled 'X'.
+    """
+    long_ = df[['db-seq', 'region']].copy()
+    long_['value'] = \
+        df['kmer'].str.replace(r'@[^|]*', '', regex=True).str.split('|')
+    long_ = long_.explode('value')
+    long_.loc[~long_['value'].isin(long_['db-seq']), 'value'] = 'X'
 
     long_.drop_duplicates(['db-seq', 'region', 'value'], inplace=True)
     
-    return long_.drop(columns=['variable'])
+    return long_
 
 
 def _get_unique_kmers(series):
-    kmers = np.hstack([[a.split("@")[0] for a in kmer.split('|')] 
-                       for kmer in series])
-    return np.sort(np.unique(kmers))
+    kmers = pd.Series(pd.unique(np.asarray(series)), dtype=object)
+    kmers = kmers.str.replace(r'@[^|]*', '', regex=True).str.split('|')
+    return np.sort(kmers.explode().unique())
+
+
+def _intersect_shared_seqs(long_):
+    """
+    Finds the sequences each database sequence shares a kmer with in every
+    region it covers
+
+    Parameters
+    ----------
+    long_: DataFrame
+        The database sequence (`db-seq`), `region` and the sequences which
+        share a kmer with it (`value`), as returned by `_get_shared_seqs`.
+
+    Returns
+    -------
+    ndarray
+        The sorted names of the database sequences
+    scipy.sparse.csr_matrix
+        A boolean (sequence x sequence + 1) matrix of the shared sequences,
+        in the same order as the names. The final column marks sequences 
+        which share a kmer with a sequence outside the database (`X`).
+    """
+    names = np.sort(long_['db-seq'].unique())
+    num_seqs = len(names)
+    codes = pd.DataFrame({
+        'seq': names.searchsorted(long_['db-seq'].values),
+        'region': pd.factorize(long_['region'])[0],
+        'value': pd.Index(names).get_indexer(long_['value'].values),
+        })
+    codes.loc[codes['value'] < 0, 'value'] = num_seqs
+    codes.drop_duplicates(inplace=True)
+
+    # A sequence is shared everywhere when it turns up in every region
+    num_regions = np.bincount(
+        codes.drop_duplicates(['seq', 'region'])['seq'].values,
+        minlength=num_seqs,
+        )
+    covered = codes.groupby(['seq', 'value']).size()
+    seqs = covered.index.get_level_values('seq').values
+    values = covered.index.get_level_values('value').values
+    everywhere = covered.values == num_regions[seqs]
+
+    shared = scipy.sparse.csr_matrix(
+        (np.ones(everywhere.sum(), dtype=bool), 
+         (seqs[everywhere], values[everywhere])),
+        shape=(num_seqs, num_seqs + 1),
+        )
+    shared.sort_indices()
+
+    return names, shared
+
+
+def _mask_sparse(matrix, rows, cols):
+    """
+    Keeps the entries of a sparse matrix in the selected rows and columns,
+    without changing its shape
+    """
+    matrix = matrix.tocoo()
+    keep = rows[matrix.row] & cols[matrix.col]
+    return scipy.sparse.csr_matrix(
+        (matrix.data[keep], (matrix.row[keep], matrix.col[keep])),
+        shape=matrix.shape,
+        )
+
+
+def _report_convergence(stats, solver, num_iter):
+    """
+    Prints the number of EM updates, the final error and the number of 
+    references pruned per sample and warns about samples which did not 
+    converge
+    """
+    print('EM updates per sample (%s):' % solver)
+    print(stats[['iterations', 'error', 'pruned']].to_string())
+    unconverged = ~stats['converged']
+    if unconverged.any():
+        warnings.warn('%i samples did not converge within %i EM updates: %s'
+                      % (unconverged.sum(), num_iter, 
+                         ', '.join(stats.index[unconverged].astype(str))),
+                      UserWarning)
 
 
 def _scale_relative_abundance(align_mat, relative, counts, seq_summary,
@@ -540,7 +795,7 @@ def _scale_relative_abundance(align_mat, relative, counts, seq_summary,
     relative : DataFrame
         a sequence x sample table giving the relative frequency of each
         sequence in each sample.
-    counts : DataFrame
+    counts : biom.Table
         The relationship between each ASV and the number of counts observed
         for that sequence
     sequence_summary : DataFrame
@@ -564,66 +819,36 @@ def _scale_relative_abundance(align_mat, relative, counts, seq_summary,
     """
     align_mat = align_mat.loc[
         align_mat[seq_name].isin(relative.ids(axis='observation')) & 
-        align_mat[asv_name].isin(counts.index)
+        align_mat[asv_name].isin(counts.ids(axis='observation'))
         ]
-    align = align_mat.pivot_table(values='norm', index=asv_name, 
-                                  columns=seq_name, fill_value=0
-                                  )
-
-    # And then we get indexing because I like to have the indexing
-    # references
-    align = align[relative.ids(axis='observation')]
-    align_seqs = align.columns
-    align_asvs = align.index
-    align = align.values
-
-    counts = counts.loc[align_asvs]
-    samples = list(relative.ids(axis='sample'))
-    spacer =  np.spacing(1)
-
-    # A simple per-sample function to solve the counts because frequency is fun
-    # and pandas rounding may be what's killing this
-    @dask.delayed
-    def _solve_sample(align, freq, count, align_seqs, sample):
-        # Probability a count shows up in a particular ASV/reference pairing
-        p_r_and_j = freq * align
-        # Normalized for the number of asvs mapped to that reference
-        p_r_given_j = \
-            p_r_and_j / np.atleast_2d(p_r_and_j.sum(axis=1) + spacer).T
-        # sums the counts
-        count_j_given_r = count.values * p_r_given_j
-
+    align_seqs = pd.Index(relative.ids(axis='observation'))
+    align_asvs = pd.Index(np.sort(align_mat[asv_name].unique()))
+    align = _build_sparse_align(align_mat, 
+                                asvs=align_asvs, 
+                                seqs=align_seqs, 
+                                seq_name=seq_name, 
+                                asv_name=asv_name,
+                                )
 
-
-        return biom.Table(
-            np.atleast_2d(count_j_given_r.sum(axis=0)).T,
-            sample_ids=[sample], observation_ids=align_seqs,
-            )
-    scaled_counts = []
-    for sample in samples:
-        non_zero_asvs = (counts[sample] > 0).values
-        non_zero_seqs = (relative.data(sample) > 0)
-        relative_seqs = relative.copy().filter(align_seqs[non_zero_seqs], 
-                                               axis='observation')
-
-        counted = _solve_sample(
-            align[non_zero_asvs][:, non_zero_seqs],
-            relative_seqs.data(sample),
-            counts.loc[non_zero_asvs, [sample]],
-            align_seqs[non_zero_seqs],
-            sample
-            )
-        scaled_counts.append(counted)
-
-    @dask.delayed
-    def _combine_tables(*tables):
-        tables = list(tables)
-        if len(tables) == 1:
-            return tables[0]
-        else:
-            return tables[0].concat(tables[1:], axis='sample')
-
-    scaled_counts = _combine_tables(*scaled_counts).compute()
+    samples = list(relative.ids(axis='sample'))
+    asv_pos = pd.Index(counts.ids(axis='observation')).get_indexer(align_asvs)
+    sample_pos = pd.Index(counts.ids(axis='sample')).get_indexer(samples)
+    counts = counts.matrix_data.tocsr()[asv_pos][:, sample_pos]
+    freq = relative.matrix_data.tocsr()
+
+    # Probability a count shows up in a particular ASV/reference pairing is
+    # align * freq. The counts for each ASV are normalized for the 
+    # probability over all the references, and then summed per reference.
+    # Pairs with no probability don't contribute anything, so everything
+    # stays sparse
+    theta = (align @ freq).tocsr()
+    theta.data = 1 / (theta.data + np.spacing(1))
+    weight = counts.multiply(theta)
+    count_j_given_r = freq.multiply(align.T @ weight).tocsr()
+
+    scaled_counts = biom.Table(count_j_given_r, 
+                               observation_ids=relative.ids(axis='observation'),
+                               sample_ids=samples)
     scaled_counts.add_metadata(
         seq_summary[['num-regions']].to_dict(orient='index'),
         axis='observation')
@@ -651,7 +876,8 @@ def _scale_relative_abundance(align_mat, relative, counts, seq_summary,
 
 def _solve_iterative_noisy(align_mat, table, seq_summary, tolerance=1e-7,
     min_abund=1e-10, num_iter=1e5, 
-    seq_name='clean_name', asv_name='asv', threads=1):
+    seq_name='clean_name', asv_name='asv', threads=1, block_size=100,
+    solver='em', prior=None):
     """
     Maps ASV abundance to reference sequences
     Parameters
@@ -659,10 +885,9 @@ def _solve_iterative_noisy(align_mat, table, seq_summary, tolerance=1e-7,
     align_mat: DataFrame
         A mapping of the match probability and error rate between matched
         kmers for iterative processing and reconstruction.
-    table: DataFrame
+    table: biom.Table
         A table combining all ASV sequences per sample (coutns for all regions) 
-        where samples are columns and ASVs are rows (biom transposition) which 
-        has been normalized per sample.
+        which has been normalized per sample.
     sequence_summary : DataFrame
         A summary of the kmers which were mapped to each of the refernece
         sequences. This describes the number regions covered, the total
@@ -682,6 +907,14 @@ def _solve_iterative_noisy(align_mat, table, seq_summary, tolerance=1e-7,
     asv_name : str, optional
         The column in `mismatch` which identifies the ASV identifer for each
         sequence that was mapped to a kmer.
+    block_size: int, optional
+        The number of samples solved together in a single task
+    solver: {'em', 'squarem'}, optional
+        The update used to solve the abundance; see 
+        `_solve_ml_em_iterative_batch`.
+    prior: biom.Table, optional
+        An earlier reconstruction used as the starting point for the samples
+        and reference sequences it shares with `table`. 
     Returns 
     -------
     DataFrame
@@ -699,45 +932,58 @@ def _solve_iterative_noisy(align_mat, table, seq_summary, tolerance=1e-7,
     # Gets the sparse alignment matrix
     # Gets the alignment matrix because its cheaper outside the loop
     # We get a sparse matrix because hopefully it works better.
-    align_mat = align_mat.loc[align_mat['asv'].isin(table.index)]
-    align = align_mat.pivot_table(values='norm', index=asv_name, 
-                                  columns=seq_name, fill_value=0
-                                  )
-    align = align.loc[table.index]
-    # And then we get indexing because I like to have the indexing
-    # references
-    align_seqs = align.columns.values
-    align_asvs = align.index.values
-
+    asvs = pd.Index(table.ids(axis='observation'))
+    samples = table.ids(axis='sample')
+    align_mat = align_mat.loc[align_mat['asv'].isin(asvs)]
+    align_seqs = np.sort(align_mat[seq_name].unique())
+    align = _build_sparse_align(align_mat, 
+                                asvs=asvs, 
+                                seqs=align_seqs, 
+                                seq_name=seq_name, 
+                                asv_name=asv_name,
+                                )
+
+    # Lines the earlier reconstruction up with the references and samples
+    # here. It stays sparse; only the slice for each block is densified
+    if prior is not None:
+        prior_seqs = pd.Index(prior.ids(axis='observation'))
+        prior_samples = pd.Index(prior.ids(axis='sample'))
+        prior_rows = prior_seqs.get_indexer(align_seqs)
+        prior_cols = prior_samples.get_indexer(samples)
+        prior_scale = seq_summary.loc[align_seqs, 'num-regions'].values
+        prior = prior.matrix_data.tocsc()
+
+    # Solves the samples together in blocks. The blocks are sliced from the
+    # sparse table so the full table is never densified.
+    abund = table.matrix_data.tocsc()
+    align = dask.delayed(align, pure=True)
     recon = []
-    for sample, col_ in table.iteritems():
-        filt_align = align.loc[col_ > 0].values
-        abund = col_[col_ > 0].values
-        sub_seqs = copy.copy(align_seqs)[(filt_align > 0).any(axis=0)]
-        filt_align = filt_align[:, (filt_align > 0).sum(axis=0) > 0]
-
-        freq_ = dask.delayed(_solve_ml_em_iterative_1_sample)(
-            align=filt_align,
-            abund=abund,
-            sample=sample,
-            align_kmers=sub_seqs,
+    for start in np.arange(0, len(samples), block_size):
+        block = slice(start, start + block_size)
+        init_freq = None
+        if prior is not None:
+            cols = prior_cols[block]
+            init_freq = dask.delayed(_densify_prior)(
+                prior=prior[:, cols[cols >= 0]],
+                rows=prior_rows,
+                present=(cols >= 0),
+                scale=prior_scale,
+                )
+        freq_ = dask.delayed(_solve_ml_em_iterative_batch)(
+            align=align,
+            abund=abund[:, block],
+            samples=samples[block],
+            align_kmers=align_seqs,
             num_iter=num_iter,
             tolerance=tolerance,
             min_abund=min_abund,
+            solver=solver,
+            init_freq=init_freq,
             )
-
         recon.append(freq_)
-    recon = dask.compute(*recon)
-    @dask.delayed
-    def _combine_tables(*tables):
-        tables = list(tables)
-        if len(tables) == 1:
-            return tables[0]
-        else:
-            return tables[0].concat(tables[1:], axis='sample')
-
-    recon = _combine_tables(*recon)
-    recon, = dask.compute(recon)
+    recon, stats = zip(*dask.compute(*recon))
+    _report_convergence(pd.concat(axis=0, objs=stats), solver, num_iter)
+    recon = _concat_samples(recon)
 
     recon.add_metadata(
         seq_summary.loc[recon.ids(axis='observation'), 
@@ -784,95 +1030,238 @@ def _solve_ml_em_iterative_1_sample(align, abund, align_kmers, sample,
     --------
     DataFrame
         The assigned relative abundance of each read
-    # TO DO: can this be solved for multipl erads at once?
     """
+    table, _ = _solve_ml_em_iterative_batch(align=align,
+                                            abund=np.atleast_2d(abund).T,
+                                            align_kmers=align_kmers,
+                                            samples=[sample],
+                                            num_iter=num_iter,
+                                            tolerance=tolerance,
+                                            min_abund=min_abund,
+                                            )
+    return table
+
+
+def _solve_ml_em_iterative_batch(align, abund, align_kmers, samples, 
+    num_iter=10000, tolerance=1e-7, min_abund=1e-10, solver='em', 
+    init_freq=None, compact_threshold=0.1):
+    """
+    Iterative expected maximization of counts and alignment for a block of
+    samples
 
-    # Our starting bact_freq estimate is here.
-    bact_freq = np.dot(align.T, abund) / np.sum(np.dot(align.T, abund))
-
-    # Solves the mixture. I'm not sure if this can be reimplemented as a
-    # gaussian mixed models problem if we have multiple samples? Because like
-    # that might actuallky make it easier? Maybe???
-    for i in np.arange(0, num_iter):
-        ### Expectation
-        # assign theta estimate for each bacteria
-        theta_i = np.dot(align, bact_freq)
-        
-        ### Maximization
-        # Adjusts the abundance and bacterial frequency
-        r_weighted = abund / (theta_i + np.spacing(1))
-        bact_factor = np.dot(r_weighted.T, align)
-        
-        # Computes errro 
-        error = np.dot(np.absolute(1 - bact_factor), bact_freq)
-        
-        # And then we get the new frequency... 
-        bact_freq = bact_freq * bact_factor
-        
-        if error < 1e-7:
-            break
+    This is the same update as `_solve_ml_em_iterative_1_sample`, written as
+    matrix products over all the samples at once. References which fall 
+    below `min_abund` are set to 0 rather than removed (a frequency of 0 
+    stays 0), and samples stop updating once they converge.
 
-        high_enough = bact_freq > min_abund
-        # if sum(~high_enough) > 0:
-            # print(np.arange(0, len(bact_freq))[~high_enough])
-        align = align[:, high_enough]
-        bact_freq = bact_freq[high_enough]
-        try:
-            align_kmers = align_kmers[high_enough]
-        except:
-            print('Could not align!', sample)
+    Parameters
+    ----------
+    align : ndarray, scipy.sparse.spmatrix
+        The (ASV x reference) alignment matrix describing the probability a 
+        given ASV belongs to a reference sequence
+    abund : ndarray, scipy.sparse.spmatrix
+        The (ASV x sample) relative abundance of each ASV feature. A sparse
+        block is densified here, so only one block is ever held densely.
+    align_kmers: ndarray
+        The names of the reference sequences
+    samples : array-like
+        The names of the samples
+    num_iter: int
+        the maximum number of EM updates per sample before giving up. Each
+        SQUAREM step counts as three updates.
+    tolerance : float
+        The error tolerance for solving the data in optimization
+    min_abund : float
+        The minimum relative abundance  to retain  a  feature
+    solver: {'em', 'squarem'}, optional
+        The update used to find the maximum likelihood abundance. `'em'` 
+        uses the SMURF multiplicative update. `'squarem'` uses squared 
+        extrapolation (SQUAREM; Varadhan and Roland, 2008) between two EM 
+        updates, followed by a stabilizing EM update, which converges to the
+        same fixed point within `tolerance` in fewer updates.
+    init_freq: ndarray, optional
+        A (reference x sample) starting frequency, for example from an 
+        earlier reconstruction of the same samples. Missing values (`nan`)
+        and zeros use the default starting frequency from the alignment.
+    compact_threshold: float, optional
+        The fraction of the working references which must be absent from 
+        every unconverged sample before the alignment is cut down to the
+        references which remain.
+
+    Returns
+    --------
+    biom.Table
+        The assigned relative abundance of each reference sequence in each
+        sample. References which are absent from every sample are omitted.
+    DataFrame
+        The number of EM updates used for each sample (`iterations`), 
+        the change at the last update (`error`), whether the sample 
+        converged (`converged`) and the number of references with a starting
+        frequency which were dropped below `min_abund` (`pruned`)
+    """
+    if scipy.sparse.issparse(abund):
+        abund = abund.toarray()
+
+    # Our starting bact_freq estimate is here.
+    align_t = align.T
+    bact_freq = np.asarray(align_t @ abund)
+    bact_freq = bact_freq / bact_freq.sum(axis=0)
+    if init_freq is not None:
+        # The multiplicative update can't bring back a reference which 
+        # starts at 0, so references the earlier solution dropped start 
+        # from the alignment like the ones it never saw
+        missing = np.isnan(init_freq) | (init_freq <= 0)
+        bact_freq = np.where(missing, bact_freq, init_freq)
+        bact_freq = bact_freq / bact_freq.sum(axis=0)
+
+    start = bact_freq > 0
+
+    iterations = np.zeros(bact_freq.shape[1], dtype=int)
+    final_error = np.full(bact_freq.shape[1], np.nan)
+    converged = np.zeros(bact_freq.shape[1], dtype=bool)
+
+    # The working problem covers the samples which haven't converged and the
+    # references which are still present in one of them. It is only cut 
+    # down when a sample converges or enough references have been pruned,
+    # so most updates work in place on the same arrays.
+    active = np.arange(0, bact_freq.shape[1])
+    refs = np.arange(0, bact_freq.shape[0])
+    sub_align, sub_align_t = align, align_t
+    freq = bact_freq.copy()
+    sub_abund = abund
+    # Every sample in the working set has had the same number of updates.
+    # A SQUAREM step takes three, so the last few are plain EM updates
+    # if fewer than three are left.
+    updates = 0
+    while updates < num_iter:
+        if (solver == 'squarem') & (num_iter - updates >= 3):
+            # Two pruned EM updates give the step and its change
+            freq1, _ = _em_update(sub_align, sub_align_t, freq, sub_abund)
+            freq1 = freq1 * (freq1 > min_abund)
+            freq2, _ = _em_update(sub_align, sub_align_t, freq1, sub_abund)
+            freq2 = freq2 * (freq2 > min_abund)
+            step = freq1 - freq
+            change = (freq2 - freq1) - step
+            # Extrapolates with the step length, falling back to the second
+            # EM update if the extrapolation leaves the simplex
+            alpha = -np.sqrt(np.square(step).sum(axis=0) / 
+                             (np.square(change).sum(axis=0) + np.spacing(1)))
+            alpha = np.minimum(alpha, -1)
+            freq = freq - 2 * alpha * step + np.square(alpha) * change
+            outside = (freq < 0).any(axis=0)
+            freq[:, outside] = freq2[:, outside]
+            iterations[active] += 2
+            updates += 2
+
+        freq, error = _em_update(sub_align, sub_align_t, freq, sub_abund)
+        iterations[active] += 1
+        updates += 1
+        final_error[active] = error
+
+        # Drops the references which are too rare from samples which haven't
+        # converged
+        done = error < tolerance
+        rare = freq <= min_abund
+        rare[:, done] = False
+        freq[rare] = 0
+
+        if done.any():
+            bact_freq[:, active] = 0
+            bact_freq[np.ix_(refs, active)] = freq
+            converged[active[done]] = True
+            active = active[~done]
+            if len(active) == 0:
+                break
+            freq = freq[:, ~done]
+            sub_abund = abund[:, active]
+
+        # Compacts the references once enough of them are absent from all 
+        # the remaining samples
+        live = (freq > 0).any(axis=1)
+        if (~live).sum() > compact_threshold * len(refs):
+            refs = refs[live]
+            freq = freq[live]
+            sub_align = align[:, refs]
+            sub_align_t = sub_align.T
+    else:
+        bact_freq[:, active] = 0
+        bact_freq[np.ix_(refs, active)] = freq
 
     # And then we do hard threshholding
     bact_freq[bact_freq <= min_abund] = 0
-    bact_freq = bact_freq / bact_freq.sum()
+    bact_freq = bact_freq / bact_freq.sum(axis=0)
+    present = (bact_freq > 0).any(axis=1)
+    pruned = (start & (bact_freq == 0)).sum(axis=0)
 
-    return biom.Table(np.atleast_2d(bact_freq).T, 
-                      observation_ids=align_kmers, 
-                      sample_ids=[sample])
+    table = biom.Table(bact_freq[present], 
+                       observation_ids=np.asarray(align_kmers)[present], 
+                       sample_ids=list(samples))
+    stats = pd.DataFrame({'iterations': iterations, 
+                          'error': final_error,
+                          'converged': converged,
+                          'pruned': pruned},
+                         index=pd.Index(samples, name='sample-id'))
 
+    return table, stats
 
-def _sort_untidy(df, clean_seqs):
-    if df['tidy']:
-        return df['shared-set']
-    else:
-        return df['shared-set'] - clean_seqs
-    
 
-def _tidy_sequence_set(clean_kmers, clean_seqs):
+def _tidy_sequence_set(shared):
     """
-    Iteratively cleans kmers by correcting overlapping sets
-    of sequences
+    Finds the sets of sequences which only share kmers with each other
+
+    A set of sequences is tidy when each sequence in the set shares a kmer
+    in every region with all the other sequences in the set and with no 
+    sequence outside it. Tidy sets are the connected components of the 
+    graph where sequences which share with each other are linked, as long 
+    as every sequence in the component shares with exactly the component.
+
+    Parameters
+    ----------
+    shared: scipy.sparse.spmatrix
+        A boolean (sequence x sequence + 1) matrix of the sequences each 
+        sequence shares a kmer with, where the final column marks kmers 
+        shared outside the database. Rows for sequences which have already 
+        been assigned are empty.
+
+    Returns
+    -------
+    ndarray
+        The tidy set each sequence belongs to, or -1 if the sequence is not
+        part of a tidy set
     """
-    
-    # Gets the sequences that are still shared with other sequences
-    shared_seqs = clean_kmers.loc[~clean_kmers['tidy']].copy()
-    shared_seqs = shared_seqs.groupby('db-seq')['shared-set'].apply(
-        lambda x: set.intersection(*x)
-    )
-    shared_seqs = shared_seqs.reset_index()
-    shared_seqs.columns = ['db-seq', 'shared-set']
-    shared_seqs['kmer'] = shared_seqs['shared-set'].apply(
-        lambda x: '|'.join(sorted(x))
-    )
-    # Updates the mapped sequence
-    clean_check = shared_seqs.groupby('kmer').apply(
-        lambda x: (set.union(*x['shared-set'].values)) == set(x['db-seq']),
+    num_seqs = shared.shape[0]
+    shared = shared.tocoo()
+    inside = shared.col < num_seqs
+
+    # Links the sequences which share with each other in both directions
+    square = scipy.sparse.csr_matrix(
+        (np.ones(inside.sum()), (shared.row[inside], shared.col[inside])),
+        shape=(num_seqs, num_seqs),
         )
-    if clean_check.any():
-        cleaned = np.hstack([
-            x.split("|") for x in clean_check.index[clean_check].values
-        ])
-        clean_seqs = clean_seqs | set(cleaned)
-    else:
-        clean_seqs = clean_seqs
-
-    clean_kmers['tidy'] = clean_kmers['db-seq'].isin(clean_seqs)
-    clean_kmers['shared-set'] = \
-        clean_kmers.apply(_sort_untidy, 
-                          clean_seqs=clean_seqs,
-                          axis=1, 
-                         )
-    return clean_kmers, clean_seqs
+    _, component = connected_components(square.multiply(square.T), 
+                                        directed=False)
+    component_size = np.bincount(component)
+
+    # Finds the component each sequence shares with, if it shares with only
+    # one component and all of it
+    entry = np.where(inside, component[np.where(inside, shared.col, 0)], -1)
+    lowest = np.full(num_seqs, num_seqs)
+    np.minimum.at(lowest, shared.row, entry)
+    highest = np.full(num_seqs, -1)
+    np.maximum.at(highest, shared.row, entry)
+    target = np.where((lowest == highest) & (lowest >= 0), lowest, -1)
+    set_size = np.bincount(shared.row, minlength=num_seqs)
+    target[(target >= 0) & 
+           (set_size != component_size[np.maximum(target, 0)])] = -1
+
+    # And keeps the components where the sequences sharing with the 
+    # component are exactly its members
+    members = np.bincount(target[target >= 0], 
+                          minlength=len(component_size))
+    tidy = members == component_size
+    tidy[component[target != component]] = False
+
+    return np.where(tidy[component], component, -1)
 
 
 def _untangle_database_ids(region_db, num_regions):
@@ -899,48 +1288,52 @@ def _untangle_database_ids(region_db, num_regions):
     """
     # Cleans up the kmers by pulling off shared labels
     region_db.drop_duplicates(['db-seq', 'kmer'], inplace=True)
-    shared = _get_shared_seqs(region_db)
-    clean_kmers = _get_clean(shared)
-    clean_kmers['tidy'] = False
-    # Formats for an id set
-    clean_kmers['shared-set'] = clean_kmers['value'].apply(
-        lambda x: set(x.split("|")))
-
-    # Sets up a while loop. Because somehow it makes sense here?
-    untidy = True
-    clean_seqs = set(['X'])
-    last_tidy = len(clean_kmers)
-
-    for i  in np.arange(0, 3):
+    names, shared = _intersect_shared_seqs(_get_shared_seqs(region_db))
+    num_seqs = len(names)
+
+    # Assigns the tidy sets, and then drops the assigned sequences (and the 
+    # sequences outside the database) from the sets that are left
+    tidy = np.zeros(num_seqs, dtype=bool)
+    assigned = np.zeros(num_seqs + 1, dtype=bool)
+    labels = np.full(num_seqs, -1)
+    untidy_shared = shared
+    for i in np.arange(0, 3):
         print(f'cleaning kners round {i}')
-        clean_kmers, clean_seqs = _tidy_sequence_set(clean_kmers, clean_seqs)
-        untidy_seqs = ~clean_kmers['tidy']
-        untidy = untidy_seqs.any()
-        if (last_tidy == untidy_seqs.sum()) | ~untidy:
+        new_labels = _tidy_sequence_set(untidy_shared)
+        cleaned = new_labels >= 0
+        labels[cleaned] = new_labels[cleaned] + i * num_seqs
+        tidy = tidy | cleaned
+        assigned[:-1] = tidy
+        assigned[-1] = True
+
+        untidy_shared = _mask_sparse(shared, ~tidy, ~assigned)
+        if not cleaned.any() or tidy.all():
             break
-        last_tidy = untidy_seqs.sum()
-    clean_kmers['shared-set'] = clean_kmers.apply(_sort_untidy, 
-                                                  clean_seqs=clean_seqs,
-                                                  axis=1, 
-                                                  )
-
-    # Maps the tidy kmers into a single kmer
-    db_map1 = clean_kmers.loc[clean_kmers['tidy']
-                             ].groupby('db-seq')['shared-set'].apply(
-        lambda x: '|'.join(sorted(set.intersection(*x)))
-    )
-    db_map1.name = 'clean_name'
+
+    # Maps the tidy sequences to their set. Most sets are a single 
+    # sequence, so only the shared sets need their names joined
+    db_map1 = pd.Series(names[tidy], 
+                        index=pd.Index(names[tidy], name='db-seq'),
+                        name='clean_name',
+                        dtype=object)
+    set_labels = pd.Series(labels[tidy], index=db_map1.index)
+    joined = set_labels.duplicated(keep=False)
+    if joined.any():
+        set_names = db_map1[joined].groupby(set_labels[joined]).apply(
+            lambda x: '|'.join(x.values))
+        db_map1[joined] = set_names.loc[set_labels[joined]].values
+
     # If anything else remains untidy, we need to continue mapping...
-    if untidy:
-        # Finds the sequences that need to be mapped and pulls out the data
-        bad_ = ~clean_kmers['tidy']
-        to_map = clean_kmers.loc[bad_]
-        unique_ids = to_map['db-seq'].unique()
-
-        to_map = to_map.groupby('db-seq')['shared-set'].apply(
-                lambda x: pd.Series(sorted(set.intersection(*x.values))),
-                ).reset_index()
-        to_map.columns = ['db-seq', 'counter', 'clean_name']
+    if not tidy.all():
+        untidy_shared = untidy_shared.tocsr()
+        untidy_shared.sort_indices()
+        row = np.repeat(np.arange(0, num_seqs), np.diff(untidy_shared.indptr))
+        to_map = pd.DataFrame({
+            'db-seq': names[row],
+            'counter': (np.arange(0, untidy_shared.nnz) - 
+                        untidy_shared.indptr[row]),
+            'clean_name': names[untidy_shared.indices],
+            })
         print('ready to detangle')
         db_map2 = _detangle_names(to_map) 
 
@@ -952,5 +1345,3 @@ def _untangle_database_ids(region_db, num_regions):
     db_map = pd.concat(axis=0, objs=[db_map1, db_map2])
     
     return db_map
-
-
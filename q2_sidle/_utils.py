@@ -1,18 +1,31 @@
+import atexit
+import itertools as it
 import os
+import time
+from collections import deque
+from contextlib import contextmanager
 
 import dask
 import numpy as np
 import pandas as pd
 import regex
 import skbio
+import yaml
 
-from dask.distributed import Client
+from dask.distributed import Client, default_client
 
 from qiime2 import Artifact, Metadata
 from qiime2.plugin import ValidationError
 from q2_feature_classifier._skl import _chunks
 from q2_types.feature_data import DNAIterator, DNAFASTAFormat
 
+# Clients started by sidle, keyed by their configuration, with the number of
+# actions currently using each one
+_client_registry = {}
+cluster_options = ['scheduler', 'n_workers', 'threads_per_worker', 
+                   'memory_limit', 'processes']
+cluster_schedulers = ['distributed', 'threads', 'processes', 'synchronous']
+
 ### Nucleotides
 degenerate_map = {"R": ['A', 'G'],
                   'Y': ['C', 'T'],
@@ -63,38 +76,247 @@ degen_undo = {'AG': 'R',
               'ACG': 'V',
               'ACGT': 'N'}
 
+# Packed nucleotides are stored as one-hot nibbles (A=1, C=2, G=4, T=8) where
+# a degenerate nucleotide sets the bits for all the bases it can represent. 
+# Sixteen nucleotides fit in a single uint64 word.
+nibble_map = {'A': 1, 'C': 2, 'G': 4, 'T': 8}
+nibble_map.update({k: sum([nibble_map[nt] for nt in v]) 
+                   for k, v in degen_sub.items() if (k in degen)})
+nibble_lookup = np.zeros(256, dtype=np.uint8)
+for nt, bits in nibble_map.items():
+    nibble_lookup[ord(nt)] = bits
+
+_nibble_low = np.uint64(0x1111111111111111)
+_byte_low = np.uint64(0x0101010101010101)
+_pair_low = np.uint64(0x5555555555555555)
+_quad_low = np.uint64(0x3333333333333333)
+
+
+@contextmanager
 def _setup_dask_client(debug=False, cluster_config=None, n_workers=1,
     address=None):
     """
     Sets up a Dask client and daskboard
 
+    A client which is already running is reused if it's compatible with the
+    request: for example, a client the user started in the same session, or 
+    one started by an action which is still running. A new client is only
+    started when none is compatible, and it is closed when the last action 
+    using it finishes.
+
     Parameters
     ----------
     debug: bool
         Whether the function should be run in debug mode (without a client)
         or not. `debug` superceeds all options
-    client_config: dict, optional
-        A dictionary describing configuration parameters for the dask client.
-        More information about configuring the dask scheduler and dask client 
+    cluster_config: str, dict, optional
+        A YAML or JSON file (or a dictionary) describing the cluster. The 
+        `scheduler` can be `"distributed"` (a dask client, the default),
+        `"threads"` or `"processes"` (a local pool without a client) or 
+        `"synchronous"` (a single thread, useful for profiling). For a 
+        distributed scheduler, `n_workers`, `threads_per_worker`, 
+        `memory_limit` and `processes` are passed to the client. More 
+        information about configuring the dask scheduler and dask client 
         can be found at
             https://docs.dask.org/en/latest/setup/single-distributed.html
-        The client_config sueprceeds the n_workers value, so if you want 
-        multi threading, that should be specified here.
+        The cluster_config sueprceeds the n_workers and address values.
     n_workers: int, optional
         The number of jobs to initiate. When `n_workers` is 0, the cluster 
         will be able to access all avalaibel resources.
     address: str, optional
         The IP address for the client
-    """
 
+    Yields
+    ------
+    dask.distributed.Client
+        The client, or `None` in debug mode or with a local scheduler
+    """
     if debug:
-        pass
-    elif cluster_config is not None:
-        client = Client(**client_config.to_dict())
+        yield None
+        return
+
+    if isinstance(cluster_config, str):
+        cluster_config = _read_cluster_config(cluster_config)
+
+    if cluster_config is not None:
+        cluster_config = cluster_config.copy()
+        scheduler = cluster_config.pop('scheduler', 'distributed')
+        if scheduler != 'distributed':
+            with dask.config.set(scheduler=scheduler, 
+                                 num_workers=cluster_config.get('n_workers')):
+                yield None
+            return
+        key = ('config', tuple(sorted(cluster_config.items())))
+    elif address is not None:
+        key = ('address', address)
+    else:
+        key = ('local', n_workers)
+
+    if key in _client_registry:
+        _client_registry[key][1] += 1
+        client = _client_registry[key][0]
+    else:
+        client = _get_dask_client()
+        if ((cluster_config is None) & 
+                _check_client_compatible(client, n_workers, address)):
+            yield client
+            return
+
+        start = time.time()
+        if cluster_config is not None:
+            client = Client(**cluster_config)
+        elif address is not None:
+            client = Client(address)
+        else:
+            client = Client(n_workers=n_workers, processes=True)
+        print('Dask client started with %i workers in %1.1f seconds' 
+              % (len(client.nthreads()), time.time() - start))
+        _client_registry[key] = [client, 1]
+
+    try:
+        yield client
+    finally:
+        _client_registry[key][1] -= 1
+        if _client_registry[key][1] == 0:
+            del _client_registry[key]
+            client.close()
+
+
+def _read_cluster_config(fp):
+    """
+    Reads and checks a YAML or JSON cluster configuration file
+
+    Parameters
+    ----------
+    fp: str
+        The path to the configuration file
+
+    Returns
+    -------
+    dict
+        The cluster configuration
+
+    Raises
+    ------
+    ValueError
+        When the file is not a mapping, has unrecognized keys, or uses an
+        unsupported scheduler
+    """
+    with open(fp, 'r') as f_:
+        config = yaml.safe_load(f_)
+
+    if config is None:
+        config = {}
+    elif not isinstance(config, dict):
+        raise ValueError('The cluster configuration must be a mapping of '
+                         'options to values.')
+    unknown = set(config.keys()) - set(cluster_options)
+    if len(unknown) > 0:
+        raise ValueError('The cluster configuration has unrecognized '
+                         'options: %s. The supported options are %s.'
+                         % (', '.join(sorted(unknown)), 
+                            ', '.join(cluster_options)))
+    if config.get('scheduler', 'distributed') not in cluster_schedulers:
+        raise ValueError('%s is not a supported scheduler. The scheduler '
+                         'must be one of %s.' 
+                         % (config['scheduler'], 
+                            ', '.join(cluster_schedulers)))
+    return config
+
+
+def _check_client_compatible(client, n_workers=1, address=None):
+    """
+    Checks whether an existing client can be reused for a request
+    """
+    if client is None:
+        return False
     elif address is not None:
-        client = Client(address)
+        return client.scheduler.address == address
+    num_workers = len(client.nthreads())
+    return (n_workers == 0) | (num_workers >= n_workers)
+
+
+def _close_dask_clients():
+    """
+    Closes any clients started by sidle which are still open
+    """
+    for key in list(_client_registry.keys()):
+        client, _ = _client_registry.pop(key)
+        client.close()
+
+
+atexit.register(_close_dask_clients)
+
+
+def _get_dask_client():
+    """
+    Gets the active distributed client, or `None` if there isn't one
+    """
+    try:
+        return default_client()
+    except ValueError:
+        return None
+
+
+def _count_dask_workers(client=None):
+    """
+    Counts the tasks that can run at once with a client or with the 
+    configured local scheduler
+    """
+    if client is not None:
+        return sum(client.nthreads().values())
+    elif dask.config.get('scheduler', None) in {'sync', 'synchronous', 
+                                                'single-threaded'}:
+        return 1
     else:
-        client = Client(n_workers=n_workers, processes=True)
+        return dask.config.get('num_workers', None) or os.cpu_count()
+
+
+def _ordered_map(func, items, client=None, window=1, **kwargs):
+    """
+    Maps a function over an iterable, yielding the results in order
+
+    Parameters
+    ----------
+    func: callable
+        The function to apply to each item
+    items: iterable
+        The items to process. This is consumed lazily so only the items in
+        flight are held in memory.
+    client: dask.distributed.Client, optional
+        The client used to run the function. If no client is supplied, the
+        items are processed in blocks of `window` with the local dask 
+        scheduler.
+    window: int, optional
+        The maximum number of items submitted at once. With a client, the 
+        results are collected in the order they were submitted, so only one 
+        result is held locally at a time.
+    kwargs:
+        Additional arguments to `func`. These can be futures scattered to 
+        the client.
+
+    Yields
+    ------
+    The result of `func` for each item
+    """
+    if client is None:
+        kwargs = {k: dask.delayed(v, pure=True) for k, v in kwargs.items()}
+        items = iter(items)
+        while True:
+            block = list(it.islice(items, window))
+            if len(block) == 0:
+                return
+            for result in dask.compute(*[dask.delayed(func)(item, **kwargs)
+                                         for item in block]):
+                yield result
+
+    pending = deque()
+    for item in items:
+        pending.append(client.submit(func, item, pure=False, **kwargs))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while len(pending) > 0:
+        yield pending.popleft().result()
 
 
 def _convert_seq_block_to_dna_fasta_format(seqs):
@@ -159,6 +381,88 @@ def _count_degenerates(seq_array):
     return num_degen
 
 
+def _pack_seqs(seqs):
+    """
+    Packs nucleotide sequences into one-hot nibbles in uint64 words
+
+    Parameters
+    ----------
+    seqs: array-like
+        The sequences to be encoded as strings. Sequences shorter than the
+        longest sequence are padded with empty nibbles.
+
+    Returns
+    -------
+    ndarray
+        A (number of sequences x number of words) uint64 array where each
+        word holds 16 nucleotides
+
+    Raises
+    ------
+    ValueError
+        If a sequence contains anything other than an uppercase IUPAC 
+        nucleotide code. Every nibble value is already in use, so these 
+        can't be packed without matching each other.
+    """
+    seqs = np.asarray(seqs).astype(bytes)
+    num_seqs = len(seqs)
+    width = seqs.dtype.itemsize
+    num_words = int(np.ceil(width / 16))
+    chars = seqs.view(np.uint8).reshape((num_seqs, width))
+    codes = np.zeros((num_seqs, num_words * 16), dtype=np.uint8)
+    codes[:, :width] = nibble_lookup[chars]
+    unknown = (codes[:, :width] == 0) & (chars > 0)
+    if unknown.any():
+        raise ValueError('Sequences can only contain the uppercase IUPAC '
+                         'nucleotide codes. %s is not a nucleotide code.'
+                         % repr(chr(chars[unknown][0])))
+    packed = codes[:, 0::2] | (codes[:, 1::2] << 4)
+
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+
+def _count_set_nibbles(words):
+    """
+    Counts the number of non-zero nibbles along the last axis of an array
+    of uint64 words
+    """
+    flags = (words | (words >> np.uint64(1)) | (words >> np.uint64(2)) | 
+             (words >> np.uint64(3))) & _nibble_low
+    flags = (flags & _byte_low) + ((flags >> np.uint64(4)) & _byte_low)
+    counts = (flags * _byte_low) >> np.uint64(56)
+    return counts.sum(axis=-1).astype(int)
+
+
+def _count_packed_degenerates(words):
+    """
+    Counts the degenerate nucleotides in each packed sequence
+    """
+    pairs = (words & _pair_low) + ((words >> np.uint64(1)) & _pair_low)
+    quads = (pairs & _quad_low) + ((pairs >> np.uint64(2)) & _quad_low)
+    multiple = ((quads >> np.uint64(1)) | (quads >> np.uint64(2))) & _nibble_low
+    return _count_set_nibbles(multiple)
+
+
+def _packed_hamming(seqs1, seqs2):
+    """
+    Counts the pairwise nucleotide mismatches between two packed sets
+    of sequences
+
+    Parameters
+    ----------
+    seqs1, seqs2: ndarray
+        The packed sequences from `_pack_seqs` with the same number of words
+
+    Returns
+    -------
+    ndarray
+        A (len(seqs1) x len(seqs2)) array with the number of positions 
+        where the nucleotides differ
+    """
+    return _count_set_nibbles(seqs1[:, np.newaxis, :] ^ 
+                              seqs2[np.newaxis, :, :])
+
+
 def _find_primer_end(seq_, primer, prefix=''):
     """
     Finds the last position of a primer sequence
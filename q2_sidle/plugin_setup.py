@@ -107,6 +107,7 @@ plugin.methods.register_function(
         'chunk_size':  (Int % Range(1, None)),
         'n_workers': Int % Range(1, None),
         'client_address': Str,
+        'cluster_config': Str,
         'debug': Bool,
 
     },
@@ -150,6 +151,13 @@ plugin.methods.register_function(
                            ' information: '
                            'https://distributed.dask.org/en/latest/client.html'
                            ),
+        'cluster_config': ('A YAML or JSON file describing the dask cluster.'
+                           ' The file can set the `scheduler` (distributed, '
+                           'threads, processes or synchronous) and, for a '
+                           'distributed scheduler, `n_workers`, '
+                           '`threads_per_worker`, `memory_limit` and '
+                           '`processes`. This superceeds `n_workers` and '
+                           '`client_address`.'),
     },
     citations=[citations['Fuks2018']],
 
@@ -176,7 +184,10 @@ plugin.methods.register_function(
         'region': Str,
         'max_mismatch': Int % Range(0, None),
         'chunk_size':  (Int % Range(1, None)),
+        'method': Str % Choices('exhaustive', 'pigeonhole'),
+        'memory_budget': Int % Range(1, None),
         'client_address': Str,
+        'cluster_config': Str,
         'n_workers': Int % Range(1, None),
         'debug': Bool,
     },
@@ -202,12 +213,32 @@ plugin.methods.register_function(
                        'relatively small (>1000) in combination with parallel'
                        ' processing (`n_workers`>1) for the best performance'
                        ' and memory optimization.'),
+        'method': ('How candidate kmer/ASV pairs are found. `exhaustive` '
+                   'compares every kmer with every ASV. `pigeonhole` splits '
+                   'the sequences into `max_mismatch` + 1 segments and only '
+                   'compares pairs which share an identical segment. Both '
+                   'methods give the same alignment; `pigeonhole` is '
+                   'typically faster for large databases with a small '
+                   '`max_mismatch`. When `max_mismatch` is 0, the alignment '
+                   'is an exact join on the sequence and this is ignored.'),
+        'memory_budget': ('The approximate memory, in megabytes, avaliable '
+                          'for the alignment blocks being processed at once.'
+                          ' Finished blocks are written to the output as '
+                          'they complete, so memory does not grow with the '
+                          'number of kmers.'),
         'n_workers': ('The number of jobs to initiate.'),
         'client_address': ('The IP address for an existing cluster. '
                           'Please see the dask client documentation for more'
                           ' information: '
                           'https://distributed.dask.org/en/latest/client.html'
                           ),
+        'cluster_config': ('A YAML or JSON file describing the dask cluster.'
+                           ' The file can set the `scheduler` (distributed, '
+                           'threads, processes or synchronous) and, for a '
+                           'distributed scheduler, `n_workers`, '
+                           '`threads_per_worker`, `memory_limit` and '
+                           '`processes`. This superceeds `n_workers` and '
+                           '`client_address`.'),
         'debug': ('Whether the function should be run in debug mode (without '
                   'a client) or not. `debug` superceeds all options'),
     },
@@ -225,6 +256,7 @@ plugin.methods.register_function(
         'regional_alignment': List[FeatureData[KmerAlignment]],
         'kmer_map': List[FeatureData[KmerMap]],
         'regional_table': List[FeatureTable[Frequency]],
+        'warm_start': FeatureTable[Frequency],
     },
     outputs=[
         ('reconstructed_table', FeatureTable[Frequency]),
@@ -238,9 +270,14 @@ plugin.methods.register_function(
         'count_degenerates': Bool,
         'region_normalize': Str % Choices('average', 'weighted', 'unweighted'),
         'min_counts': Int % Range(0, None),
+        'solver': Str % Choices('em', 'squarem'),
+        'tolerance': Float % Range(0, None),
+        'num_iter': Int % Range(1, None),
+        'sample_batch': Int % Range(1, None),
         'block_size': Int,
         'n_workers': Int % Range(1, None),
         'client_address': Str,
+        'cluster_config': Str,
         'debug': Bool,
     },
     input_descriptions={
@@ -254,7 +291,14 @@ plugin.methods.register_function(
         'regional_table': ('A feature-table for each region, where  the '
                            'features in the table correspond to the ASVs '
                            'which were aligned in the regional alignment '
-                           'artifact')
+                           'artifact'),
+        'warm_start': ('A table reconstructed in an earlier run from the same'
+                       ' samples. Each sample in the table starts from its '
+                       'earlier solution, so reruns of a mostly unchanged '
+                       'set of samples converge in fewer iterations. '
+                       'Reference sequences which are new or which the '
+                       'earlier run assigned no abundance to start from the '
+                       'alignment.'),
     },
     output_descriptions={
         'reconstructed_table': ('The feature table with the reconstructed '
@@ -289,6 +333,24 @@ plugin.methods.register_function(
                       ' on the total number of sequences in your sample'),
         'min_counts': ('The mininum depth across all regions after alignment '
                        'for a sample to be included in a reconstruction'),
+        'solver': ('The update used to solve the relative abundance. `em` '
+                   'is the SMURF expectation maximization update. `squarem` '
+                   'uses squared extrapolation between EM updates, which '
+                   'converges to the same fixed point within `tolerance` in '
+                   'fewer updates. The number of updates used for each '
+                   'sample is reported.'),
+        'tolerance': ('The total change in reference frequencies between EM '
+                      'updates below which a sample is considered converged.'
+                      ' A larger tolerance is faster but less accurate, '
+                      'which may be acceptable for screening runs.'),
+        'num_iter': ('The maximum number of EM updates for each sample. '
+                     'Samples which do not converge within this number of '
+                     'updates are reported.'),
+        'sample_batch': ('The number of samples to reconstruct together. '
+                         'Samples are solved and scaled one batch at a '
+                         'time, so memory depends on the batch size rather '
+                         'than the total number of samples. By default, all '
+                         'samples are reconstructed together.'),
         'region_normalize': ('Whether the relative abundance should be '
                              'normalized by region during reconstruction. '
                              'When using kmer-based alignment to '
@@ -306,6 +368,13 @@ plugin.methods.register_function(
                           ' information: '
                           'https://distributed.dask.org/en/latest/client.html'
                           ),
+        'cluster_config': ('A YAML or JSON file describing the dask cluster.'
+                           ' The file can set the `scheduler` (distributed, '
+                           'threads, processes or synchronous) and, for a '
+                           'distributed scheduler, `n_workers`, '
+                           '`threads_per_worker`, `memory_limit` and '
+                           '`processes`. This superceeds `n_workers` and '
+                           '`client_address`.'),
         'debug': ('Whether the function should be run in debug mode (without '
                   'a client) or not. `debug` superceeds all options'),
     },
@@ -10,7 +10,11 @@ from q2_types.feature_data import DNAIterator, DNAFASTAFormat
 
 from q2_sidle._align import (align_regional_kmers,
                              _align_kmers,
-                             _check_read_lengths,                        
+                             _align_kmers_exact,
+                             _align_kmers_pigeonhole,
+                             _budget_block_size,
+                             _build_seed_index,
+                             _check_read_lengths,
                              )
 
 
@@ -60,6 +64,79 @@ class AlignTest(TestCase):
         known0.reset_index(drop=True, inplace=True)
         pdt.assert_frame_equal(known0, test0.reset_index(drop=True))
 
+    def test_align_kmers_block_size(self):
+        known = pd.DataFrame(
+          data=[['A', 'r2.0', 4, 0],
+                ['A', 'r2.2', 4, 1],
+                ],
+          columns=['kmer', 'asv', 'length', 'mismatch']
+        )
+        known[['mismatch', 'length']] = \
+            known[['mismatch', 'length']].astype(int)
+        test = _align_kmers(self.seq_array.astype(str),
+                            self.reads2,
+                            allowed_mismatch=2,
+                            block_size=2,
+                            )
+        pdt.assert_frame_equal(known, test.reset_index(drop=True))
+
+    def test_align_kmers_pigeonhole(self):
+        np.random.seed(5)
+        bases = np.array(list('ACGT'))
+        reads1 = pd.Series(
+            data=[''.join(x) for x in np.random.choice(bases, (50, 20))],
+            index=['k%i' % i for i in np.arange(50)],
+            )
+        # Mutates copies of the kmers so some fall within the cutoff
+        reads2 = reads1.apply(
+            lambda x: ''.join([b if np.random.rand() > 0.1 else 'A' 
+                               for b in x])
+            )
+        reads2.index = ['a%i' % i for i in np.arange(50)]
+        known = _align_kmers(reads1, reads2, allowed_mismatch=2)
+        test = _align_kmers_pigeonhole(reads1, reads2, allowed_mismatch=2,
+                                       block_size=3)
+        self.assertTrue(len(known) > 0)
+        pdt.assert_frame_equal(known, test)
+
+    def test_align_kmers_unknown_error(self):
+        reads1 = pd.Series(['acgt'], index=['k'])
+        reads2 = pd.Series(['tgca'], index=['a'])
+        with self.assertRaises(ValueError):
+            _align_kmers(reads1, reads2, allowed_mismatch=0)
+        with self.assertRaises(ValueError):
+            _align_kmers_pigeonhole(reads1, reads2, allowed_mismatch=0)
+
+    def test_align_kmers_pigeonhole_seed_index(self):
+        known = _align_kmers(self.seq_array.astype(str), self.reads2, 
+                             allowed_mismatch=1)
+        test = _align_kmers_pigeonhole(
+            self.seq_array.astype(str), 
+            self.reads2, 
+            allowed_mismatch=1,
+            seed_index=_build_seed_index(self.reads2, 1),
+            )
+        pdt.assert_frame_equal(known, test)
+
+    def test_align_kmers_exact(self):
+        reads1 = pd.Series(data=['AGTC', 'AGTT', 'AGTC', 'CCCC'],
+                           index=['k0', 'k1', 'k2', 'k3'])
+        reads2 = pd.Series(data=['AGTC', 'AGTC', 'AGTT', 'ATTT'],
+                           index=['a0', 'a1', 'a2', 'a3'])
+        known = _align_kmers(reads1, reads2, allowed_mismatch=0)
+        test = _align_kmers_exact(reads1, reads2)
+        self.assertEqual(len(test), 5)
+        pdt.assert_frame_equal(known, test)
+
+    def test_build_seed_index(self):
+        known = pd.DataFrame(
+            data=[[0, 'AG', 0], [0, 'WG', 1], [0, 'AG', 2],
+                  [1, 'TC', 0], [1, 'WN', 1], [1, 'TT', 2]],
+            columns=['segment', 'seed', 'pos'],
+            )
+        test = _build_seed_index(self.reads2, 1)
+        pdt.assert_frame_equal(known, test, check_dtype=False)
+
     def test_align_regional_kmers(self):
         kmers = Artifact.import_data('FeatureData[Sequence]', pd.Series({
             'seq1|seq2': DNA('GCGAAGCGGCTCAGG', metadata={'id': 'seq1 | seq2'}),
@@ -109,7 +186,24 @@ class AlignTest(TestCase):
             match.view(pd.DataFrame).sort_values(['kmer', 'asv']
                 ).reset_index(drop=True)
             )
+        seeded = align_regional_kmers(kmers.view(pd.Series),
+                                      rep_set.view(pd.Series),
+                                      region='Bludhaven',
+                                      debug=True,
+                                      chunk_size=2,
+                                      method='pigeonhole',
+                                      )
+        with open(str(match)) as f_:
+            known_file = f_.read()
+        with open(str(seeded)) as f_:
+            self.assertEqual(known_file, f_.read())
+
 
+    def test_budget_block_size(self):
+        # 100 nt is 7 words; 7 * 8 * 4 = 224 bytes per pair
+        self.assertEqual(_budget_block_size(1, 100), 66)
+        self.assertEqual(_budget_block_size(1, 100, window=4), 33)
+        self.assertEqual(_budget_block_size(0, 100), 1)
 
     def test_check_read_length_pass(self):
         number_, length_ = _check_read_lengths(self.in_mer, 'inmer')
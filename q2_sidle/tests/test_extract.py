@@ -136,6 +136,36 @@ class ExtractTest(TestCase):
                              'fwd-primer', 'rev-primer', 'kmer-length']]
         pdt.assert_frame_equal(test_map, known_map)
 
+    def test_prepared_extracted_region_degenerate_shared(self):
+        # A degenerate reference shares the kmer for each expansion that
+        # matches another reference
+        seqs = Artifact.import_data('FeatureData[Sequence]', pd.Series({
+            'seq1': skbio.DNA('GCGAAGCGGCTCRGG', metadata={'id': 'seq1'}),
+            'seq2': skbio.DNA('GCGAAGCGGCTCAGG', metadata={'id': 'seq2'}),
+            }))
+        known_seqs = pd.Series({'seq1@0001|seq2': 'GCGAAGCGGCTCAGG',
+                                'seq1@0002': 'GCGAAGCGGCTCGGG'})
+        known_map = pd.DataFrame(
+            data=[['seq1@0001', 'seq1@0001|seq2'],
+                  ['seq1@0002', 'seq1@0002'],
+                  ['seq2', 'seq1@0001|seq2']],
+            index=pd.Index(['seq1', 'seq1', 'seq2'], name='db-seq'),
+            columns=['seq-name', 'kmer'],
+            )
+        test_seqs, test_map = \
+            prepare_extracted_region(sequences=seqs, 
+                                     region='Gotham',
+                                     trim_length=15,
+                                     debug=True,
+                                     fwd_primer='WANTCAT',
+                                     rev_primer='CATCATCAT',
+                                     )
+        pdt.assert_series_equal(
+            test_seqs.view(pd.Series).astype(str).sort_index(), 
+            known_seqs)
+        test_map.sort_values(['db-seq', 'seq-name'], inplace=True)
+        pdt.assert_frame_equal(test_map[['seq-name', 'kmer']], known_map)
+
     def test_artifical_trim_fwd(self):
         test = _artifical_trim(self.seq_block, 15)
         pdt.assert_frame_equal(test, self.amplicon)
@@ -200,7 +230,7 @@ class ExtractTest(TestCase):
 
     def test_expand_ids(self):
         test = _expand_ids(self.group_forward, self.fwd_primer, 'ATGATGATG',
-                           'Bludhaven', 15, 1000).compute()
+                           'Bludhaven', 15)
         test = test[['db-seq', 'seq-name', 'kmer', 'region', 
                      'fwd-primer', 'rev-primer', 'kmer-length']]
         test.set_index('db-seq', inplace=True)
@@ -11,23 +11,27 @@ import numpy as np
 import numpy.testing as npt
 import pandas as pd
 import pandas.testing as pdt
+import scipy.sparse
 import skbio
 
 from qiime2 import Artifact, Metadata
 from qiime2.plugin import ValidationError
 
 from q2_sidle._reconstruct import (reconstruct_counts,
+                                   _build_sparse_align,
+                                   _concat_samples,
                                    _construct_align_mat,
                                    _count_mapping,
+                                   _densify_prior,
                                    _detangle_names,
                                    _expand_duplicate_sequences,
-                                   _get_clean,
                                    _get_shared_seqs,
                                    _get_unique_kmers,
+                                   _intersect_shared_seqs,
                                    _scale_relative_abundance,
                                    _solve_ml_em_iterative_1_sample,
+                                   _solve_ml_em_iterative_batch,
                                    _solve_iterative_noisy,
-                                   _sort_untidy,
                                    _tidy_sequence_set,
                                    _untangle_database_ids,
                                    )
@@ -147,13 +151,13 @@ class ReconstructTest(TestCase):
                     },
             })
         self.seq_summary.index.set_names('clean_name', inplace=True)
-        self.table = pd.DataFrame(
-            data=np.array([[20, 10, 10, 10, 10, 10, 10, 10, 10, 10]]),
-            index=['s.1'],
-            columns=['asv01', 'asv02', 'asv04', 'asv05', 'asv06', 
-                     'asv07', 'asv08', 'asv09', 'asv10', 'asv11']
-            ).T
-        self.table = self.table / self.table.sum()
+        self.table = biom.Table(
+            data=np.array([[20, 10, 10, 10, 10, 10, 10, 10, 10, 10]]).T,
+            sample_ids=['s.1'],
+            observation_ids=['asv01', 'asv02', 'asv04', 'asv05', 'asv06', 
+                             'asv07', 'asv08', 'asv09', 'asv10', 'asv11'],
+            )
+        self.table = self.table.norm(axis='sample', inplace=False)
         self.freq = biom.Table(
             np.array([[0.1818, 0.1818, 0.1818, 0.0909, 0.1818, 0.1818]]).T,
             observation_ids=['seq1', 'seq2', 'seq3', 'seq4', 'seq5', 'seq6'],
@@ -269,6 +273,34 @@ class ReconstructTest(TestCase):
         pdt.assert_frame_equal(known_map, mapping)
         pdt.assert_frame_equal(known_summary, summary.to_dataframe())
 
+    def test_reconstruct_counts_sample_batch(self):
+        count_table, summary, mapping = reconstruct_counts(
+              region=['Bludhaven', 'Gotham'],
+              regional_alignment=[ts.region1_align.view(pd.DataFrame).copy(), 
+                                  ts.region2_align.view(pd.DataFrame).copy()],
+              kmer_map=[ts.region1_db_map.view(pd.DataFrame).copy(), 
+                        ts.region2_db_map.view(pd.DataFrame).copy()],
+              regional_table=[ts.region1_counts.view(biom.Table),
+                              ts.region2_counts.view(biom.Table)],
+              debug=True, 
+              min_counts=10,
+              min_abund=1e-2,
+              sample_batch=2)
+        npt.assert_array_equal(
+            np.array(count_table.matrix_data.todense()),
+            np.array([[100,  50,   0,  50,  50, 50],
+                      [100,  25, 100,  25,  25, 25],
+                      [  0, 100, 100,   0,  50, 50]]).T
+           )
+        npt.assert_array_equal(
+            np.array(list(count_table.ids(axis='sample'))),
+            np.array(['sample1', 'sample2', 'sample3'])
+        )
+        npt.assert_array_equal(
+            np.array(list(count_table.ids(axis='observation'))),
+            np.array(['seq1', 'seq2', 'seq3', 'seq4', 'seq5', 'seq6']),
+        )
+
     def test_reconstruct_counts_unweighted(self):
         known_map = pd.DataFrame(
             data=[['seq1', 'WANTCAT', 'CACCTCGTN', 15],
@@ -459,6 +491,50 @@ class ReconstructTest(TestCase):
         pdt.assert_frame_equal(summary.to_dataframe(), 
                                known_summary)
 
+    def test_build_sparse_align(self):
+        align_mat = pd.DataFrame(
+            data=[['asv01', 'seq1', 0.5],
+                  ['asv01', 'seq2', 0.25],
+                  ['asv02', 'seq2', 1.0],
+                  ['asv02', 'seq2', 0.5],
+                  ['asv03', 'seq3', 1.0]],
+            columns=['asv', 'clean_name', 'norm']
+            )
+        known = np.array([[0.75, 0],
+                          [0.25, 0.5],
+                          [0, 0]])
+        test = _build_sparse_align(align_mat, 
+                                   asvs=['asv02', 'asv01', 'asv04'],
+                                   seqs=['seq2', 'seq1'])
+        self.assertEqual(test.shape, (3, 2))
+        npt.assert_array_equal(test.toarray(), known)
+
+    def test_concat_samples(self):
+        table1 = biom.Table(
+            data=np.array([[1, 0], [2, 3]]),
+            observation_ids=['seq1', 'seq3'],
+            sample_ids=['s.1', 's.2'],
+            observation_metadata=[{'num-regions': 1}, {'num-regions': 2}],
+            )
+        table2 = biom.Table(
+            data=np.array([[4], [5]]),
+            observation_ids=['seq2', 'seq1'],
+            sample_ids=['s.3'],
+            observation_metadata=[{'num-regions': 2}, {'num-regions': 1}],
+            )
+        known = table1.concat([table2], axis='sample')
+        test = _concat_samples([table1, table2])
+        npt.assert_array_equal(list(known.ids(axis='observation')),
+                               list(test.ids(axis='observation')))
+        npt.assert_array_equal(list(known.ids(axis='sample')),
+                               list(test.ids(axis='sample')))
+        npt.assert_array_equal(known.matrix_data.toarray(),
+                               test.matrix_data.toarray())
+        self.assertEqual(
+            [md['num-regions'] for md in test.metadata(axis='observation')],
+            [1, 2, 2]
+            )
+
     def test_construct_align_mat(self):
         sequence_map = pd.Series({'seq1': 'seq1',
                                   'seq2': 'seq2',
@@ -508,6 +584,22 @@ class ReconstructTest(TestCase):
         test = _count_mapping(self.pair, count_degen=False)
         pdt.assert_frame_equal(test, known)
 
+    def test_densify_prior(self):
+        # seq2 and seq4 are in the prior, seq1 and seq3 aren't; the second
+        # sample wasn't reconstructed earlier
+        prior = scipy.sparse.csc_matrix(np.array([[0.25], [0.5]]))
+        test = _densify_prior(prior, 
+                              rows=np.array([-1, 1, -1, 0]),
+                              present=np.array([True, False]),
+                              scale=np.array([1, 1, 2, 2]))
+        npt.assert_almost_equal(
+            test,
+            np.array([[np.nan, np.nan], 
+                      [0.5, np.nan], 
+                      [np.nan, np.nan], 
+                      [0.5, np.nan]])
+            )
+
     def test_detangle_names(self):
         long_ = pd.DataFrame(
             data=[['seq00', 'seq00', 0],
@@ -584,18 +676,6 @@ class ReconstructTest(TestCase):
 
         pdt.assert_frame_equal(test, known)
 
-    def test_get_clean(self):
-        known = pd.DataFrame(
-            data=[['seq1', 'Bludhaven', 'seq1|seq2'],
-                  ['seq2', 'Bludhaven', 'seq1|seq2'],
-                  ['seq3', 'Bludhaven', 'seq3'],
-                  ['seq5', 'Bludhaven', 'seq5'],
-                  ['seq6', 'Bludhaven', 'seq6']],
-            columns=['db-seq', 'region', 'value']
-            )
-        test = _get_clean(self.shared_long)
-        pdt.assert_frame_equal(test, known)
-
     def test_get_shared(self):
         test = _get_shared_seqs(self.kmer1.reset_index())
         test.sort_values(['db-seq', 'value'], inplace=True)
@@ -609,18 +689,38 @@ class ReconstructTest(TestCase):
         test = _get_unique_kmers(test)
         npt.assert_array_equal(test, known)
 
+    def test_intersect_shared_seqs(self):
+        long_ = pd.concat(axis=0, objs=[
+            self.shared_long,
+            pd.DataFrame(data=[['seq1', 'Gotham', 'seq1'],
+                               ['seq2', 'Gotham', 'seq1'],
+                               ['seq2', 'Gotham', 'seq2'],
+                               ['seq3', 'Gotham', 'seq3'],
+                               ['seq3', 'Gotham', 'X']],
+                         columns=['db-seq', 'region', 'value']),
+            ])
+        known = np.array([[1, 0, 0, 0, 0, 0],
+                          [1, 1, 0, 0, 0, 0],
+                          [0, 0, 1, 0, 0, 0],
+                          [0, 0, 0, 1, 0, 0],
+                          [0, 0, 0, 0, 1, 0]], dtype=bool)
+        names, shared = _intersect_shared_seqs(long_)
+        npt.assert_array_equal(names, 
+                               ['seq1', 'seq2', 'seq3', 'seq5', 'seq6'])
+        npt.assert_array_equal(shared.toarray(), known)
+
     def test_scale_relative_abundance_average(self):
         known = biom.Table(
             data=np.array([[10., 10., 10., 10., 10., 10.]]).T,
             sample_ids=['sample.1'],
             observation_ids=['seq1', 'seq2', 'seq3', 'seq4', 'seq5', 'seq6'],
             )
-        counts = pd.DataFrame(
-            data=np.array([[20, 10, 10, 10, 10, 10, 10, 10, 10, 10]]),
-            index=['sample.1'],
-            columns=['asv01', 'asv02', 'asv04', 'asv05', 'asv06', 
-                     'asv07', 'asv08', 'asv09', 'asv10', 'asv11']
-            ).T
+        counts = biom.Table(
+            data=np.array([[20, 10, 10, 10, 10, 10, 10, 10, 10, 10]]).T,
+            sample_ids=['sample.1'],
+            observation_ids=['asv01', 'asv02', 'asv04', 'asv05', 'asv06', 
+                             'asv07', 'asv08', 'asv09', 'asv10', 'asv11'],
+            )
         test = _scale_relative_abundance(
             pd.concat([self.align1, self.align2]),
             relative=self.freq,
@@ -642,12 +742,12 @@ class ReconstructTest(TestCase):
             sample_ids=['sample.1'],
             observation_ids=['seq1', 'seq2', 'seq3', 'seq4', 'seq5', 'seq6'],
             )
-        counts = pd.DataFrame(
-            data=np.array([[20, 10, 10, 10, 10, 10, 10, 10, 10, 10]]),
-            index=['sample.1'],
-            columns=['asv01', 'asv02', 'asv04', 'asv05', 'asv06', 
-                     'asv07', 'asv08', 'asv09', 'asv10', 'asv11']
-            ).T
+        counts = biom.Table(
+            data=np.array([[20, 10, 10, 10, 10, 10, 10, 10, 10, 10]]).T,
+            sample_ids=['sample.1'],
+            observation_ids=['asv01', 'asv02', 'asv04', 'asv05', 'asv06', 
+                             'asv07', 'asv08', 'asv09', 'asv10', 'asv11'],
+            )
         test = _scale_relative_abundance(
             pd.concat([self.align1, self.align2]),
             relative=self.freq,
@@ -672,7 +772,7 @@ class ReconstructTest(TestCase):
         ).T
         test = _solve_iterative_noisy(
             align_mat=pd.concat([self.align1, self.align2]),
-            table=self.table / self.table.sum(),
+            table=self.table,
             seq_summary=self.seq_summary,
             )
         npt.assert_array_equal(['s.1'], list(test.ids(axis='sample')))
@@ -718,8 +818,181 @@ class ReconstructTest(TestCase):
             t_freq.matrix_data.todense().round(4)
         )
 
-    def test_sort_untidy(self):
-        pass
+    def test_solve_ml_em_iterative_batch(self):
+        align = np.array([
+            [0.4638, 0.4638, 0,      0,      0,      0     ],
+            [0,      0,      0.4638, 0,      0,      0     ],
+            [0,      0,      0,      0,      0.4638, 0.0008],
+            [0,      0,      0,      0,      0.0008, 0.4638],
+            [0.4638, 0,      0 ,     0,      0,      0     ],
+            [0,      0.4638, 0,      0,      0,      0     ],
+            [0,      0,      0.4638, 0,      0,      0     ],
+            [0,      0,      0,      0.9276, 0,      0     ],
+            [0,      0,      0,      0,      0.4638, 0     ],
+            [0,      0,      0,      0,      0,      0.4638]])
+        abund = np.array([[2, 1, 1, 1, 1, 1, 1, 1, 1, 1],
+                          [0, 1, 3, 1, 0, 0, 1, 2, 1, 1]]).T
+        abund = abund / abund.sum(axis=0)
+        kmers = np.array(['seq1', 'seq2', 'seq3', 'seq4', 'seq5', 'seq6'])
+
+        test, stats = _solve_ml_em_iterative_batch(align=align, 
+                                                   abund=abund, 
+                                                   align_kmers=kmers,
+                                                   samples=['s.1', 's.2'],
+                                                   )
+        npt.assert_array_equal(['s.1', 's.2'], 
+                               list(test.ids(axis='sample')))
+        npt.assert_array_equal(stats.index, ['s.1', 's.2'])
+        self.assertTrue(stats['converged'].all())
+        npt.assert_array_equal(kmers, list(test.ids(axis='observation')))
+        for i, sample in enumerate(['s.1', 's.2']):
+            single = _solve_ml_em_iterative_1_sample(
+                align=align[abund[:, i] > 0], 
+                abund=abund[abund[:, i] > 0, i],
+                align_kmers=kmers,
+                sample=sample,
+                )
+            single = pd.Series(single.matrix_data.toarray()[:, 0], 
+                               index=single.ids(axis='observation'))
+            npt.assert_almost_equal(
+                single.reindex(kmers).fillna(0).values,
+                test.data(sample, axis='sample', dense=True)
+                )
+
+    def test_solve_ml_em_iterative_batch_squarem(self):
+        np.random.seed(3)
+        align = np.random.rand(40, 15) * (np.random.rand(40, 15) > 0.7)
+        abund = np.random.rand(40, 4) * (np.random.rand(40, 4) > 0.2)
+        abund = abund / abund.sum(axis=0)
+        kmers = np.array(['seq%i' % i for i in np.arange(15)])
+        samples = ['s.1', 's.2', 's.3', 's.4']
+
+        em, em_stats = _solve_ml_em_iterative_batch(
+            align=align, abund=abund, align_kmers=kmers, samples=samples,
+            tolerance=1e-10, min_abund=1e-5,
+            )
+        sq, sq_stats = _solve_ml_em_iterative_batch(
+            align=align, abund=abund, align_kmers=kmers, samples=samples,
+            tolerance=1e-10, min_abund=1e-5, solver='squarem'
+            )
+        self.assertTrue(sq_stats['converged'].all())
+        self.assertTrue((sq_stats['iterations'] < 
+                         em_stats['iterations']).all())
+        npt.assert_almost_equal(
+            em.to_dataframe(dense=True).values,
+            sq.sort_order(em.ids(axis='observation'), 
+                          axis='observation').to_dataframe(dense=True).values,
+            decimal=4,
+            )
+
+    def test_solve_ml_em_iterative_batch_stats(self):
+        np.random.seed(3)
+        align = np.random.rand(40, 15) * (np.random.rand(40, 15) > 0.7)
+        abund = np.random.rand(40, 3) * (np.random.rand(40, 3) > 0.2)
+        abund = abund / abund.sum(axis=0)
+        kmers = np.array(['seq%i' % i for i in np.arange(15)])
+        samples = ['s.1', 's.2', 's.3']
+
+        test, stats = _solve_ml_em_iterative_batch(
+            align=align, abund=abund, align_kmers=kmers, samples=samples,
+            tolerance=1e-3, min_abund=1e-2,
+            )
+        self.assertEqual(list(stats.columns), 
+                         ['iterations', 'error', 'converged', 'pruned'])
+        self.assertTrue(stats['converged'].all())
+        self.assertTrue((stats['error'] < 1e-3).all())
+        npt.assert_array_equal(
+            stats['pruned'].values,
+            15 - (test.to_dataframe(dense=True).reindex(kmers).fillna(0) 
+                  > 0).sum(axis=0).values,
+            )
+
+        short, short_stats = _solve_ml_em_iterative_batch(
+            align=align, abund=abund, align_kmers=kmers, samples=samples,
+            tolerance=1e-12, min_abund=1e-2, num_iter=3,
+            )
+        npt.assert_array_equal(short_stats['iterations'], [3, 3, 3])
+        self.assertFalse(short_stats['converged'].any())
+        self.assertTrue((short_stats['error'] > 1e-12).all())
+
+        for num_iter in [3, 4, 5]:
+            short, short_stats = _solve_ml_em_iterative_batch(
+                align=align, abund=abund, align_kmers=kmers, samples=samples,
+                tolerance=1e-12, min_abund=1e-2, num_iter=num_iter, 
+                solver='squarem',
+                )
+            npt.assert_array_equal(short_stats['iterations'], [num_iter] * 3)
+            self.assertFalse(short_stats['converged'].any())
+
+    def test_solve_ml_em_iterative_batch_warm_start(self):
+        np.random.seed(3)
+        align = np.random.rand(40, 15) * (np.random.rand(40, 15) > 0.7)
+        abund = np.random.rand(40, 3) * (np.random.rand(40, 3) > 0.2)
+        abund = abund / abund.sum(axis=0)
+        kmers = np.array(['seq%i' % i for i in np.arange(15)])
+        samples = ['s.1', 's.2', 's.3']
+
+        cold, cold_stats = _solve_ml_em_iterative_batch(
+            align=align, abund=abund, align_kmers=kmers, samples=samples,
+            tolerance=1e-10, min_abund=1e-5,
+            )
+        init_freq = cold.to_dataframe(dense=True).reindex(kmers).fillna(0)
+        init_freq = init_freq.values
+        # The third sample wasn't solved earlier and the first sample is 
+        # missing a reference
+        init_freq[:, 2] = np.nan
+        init_freq[0, 0] = np.nan
+        warm, warm_stats = _solve_ml_em_iterative_batch(
+            align=align, abund=abund, align_kmers=kmers, samples=samples,
+            tolerance=1e-10, min_abund=1e-5, init_freq=init_freq,
+            )
+        self.assertTrue(warm_stats['iterations']['s.2'] < 
+                        cold_stats['iterations']['s.2'])
+        self.assertEqual(warm_stats['iterations']['s.3'], 
+                         cold_stats['iterations']['s.3'])
+        npt.assert_almost_equal(
+            cold.to_dataframe(dense=True).values,
+            warm.sort_order(cold.ids(axis='observation'), axis='observation'
+                            ).to_dataframe(dense=True).values,
+            decimal=4,
+            )
+
+    def test_solve_ml_em_iterative_batch_warm_start_zero(self):
+        align = np.array([[0.5, 0.5, 0], [0, 0.5, 0.5], [0, 0, 1]])
+        abund = np.array([[0.4, 0.3, 0.3]]).T
+        kmers = np.array(['seq1', 'seq2', 'seq3'])
+        cold, _ = _solve_ml_em_iterative_batch(
+            align=align, abund=abund, align_kmers=kmers, samples=['s.1'],
+            tolerance=1e-12, min_abund=1e-10,
+            )
+        # The earlier solution dropped seq2, which the cold solution needs
+        warm, _ = _solve_ml_em_iterative_batch(
+            align=align, abund=abund, align_kmers=kmers, samples=['s.1'],
+            tolerance=1e-12, min_abund=1e-10, 
+            init_freq=np.array([[0.4, 0, 0.6]]).T,
+            )
+        npt.assert_array_equal(list(cold.ids(axis='observation')),
+                               ['seq2', 'seq3'])
+        npt.assert_array_equal(list(warm.ids(axis='observation')),
+                               ['seq2', 'seq3'])
+        npt.assert_almost_equal(cold.matrix_data.toarray(),
+                                warm.matrix_data.toarray())
+
+    def test_solve_iterative_noisy_prior(self):
+        align_mat = pd.concat([self.align1, self.align2])
+        cold = _solve_iterative_noisy(
+            align_mat=align_mat,
+            table=self.table,
+            seq_summary=self.seq_summary,
+            )
+        warm = _solve_iterative_noisy(
+            align_mat=align_mat,
+            table=self.table,
+            seq_summary=self.seq_summary,
+            prior=cold,
+            )
+        npt.assert_almost_equal(cold.matrix_data.toarray(), 
+                                warm.matrix_data.toarray())
 
     def test_tidy_sequence_set(self):
         clean_kmer = pd.DataFrame(
@@ -747,57 +1020,18 @@ class ReconstructTest(TestCase):
                   ['seq22', 1, {'seq21', 'seq22', 'seq23'}],
                   ['seq23', 1, {'seq21', 'seq22', 'seq23'}], ['seq23', 2, {'seq23'}]]
             )
-        clean_kmer['tidy'] = False
-        known_seqs = set(['seq00', 'seq01', 'seq02', 'seq05', 'seq06',
-                          'seq07', 'seq09', 'seq10', 'seq11', 'seq16', 'seq17', 
-                          'seq19', 'seq20', 'seq21', 'seq23'])
-        known_kmers = pd.DataFrame(
-            columns=['db-seq', 'region', 'shared-set', 'tidy'],
-            data=[['seq00', 0, 'seq00', True], 
-                  ['seq00', 1, 'seq00', True],
-                  ['seq01', 0, 'seq01|seq02', True], 
-                  ['seq01', 1, 'seq01', True],
-                  ['seq02', 0, 'seq01|seq02', True],
-                  ['seq02', 1, 'seq02', True],
-                  ['seq05', 0, 'seq05', True],
-                  ['seq05', 1, 'seq05|seq06', True],
-                  ['seq06', 0, 'seq06', True],
-                  ['seq06', 1, 'seq05|seq06', True],
-                  ['seq07', 0, 'seq07', True], 
-                  ['seq08', 0, 'seq08', False],
-                  ['seq09', 0, 'seq08|seq09', True],
-                  ['seq09', 1, 'seq09', True],
-                  ['seq10', 0, 'seq10|seq11', True],
-                  ['seq10', 1, 'seq10|seq11', True],
-                  ['seq11', 0, 'seq10|seq11', True], 
-                  ['seq11', 1, 'seq10|seq11', True],
-                  ['seq12', 0, 'seq12|seq13|seq14', False], 
-                  ['seq12', 1, 'seq12|seq14|seq15', False],
-                  ['seq13', 0, 'seq12|seq13|seq14', False], 
-                  ['seq13', 1, 'seq13|seq14|seq15', False],
-                  ['seq14', 0, 'seq12|seq13|seq14', False], 
-                  ['seq14', 1, 'seq12|seq13|seq14|seq15', False],
-                  ['seq15', 1, 'seq12|seq13|seq14|seq15', False],
-                  ['seq16', 0, 'seq16', True], 
-                  ['seq16', 1, 'seq16|seq17', True],
-                  ['seq17', 0, 'seq17|seq18', True], 
-                  ['seq17', 1, 'seq16|seq17', True],
-                  ['seq18', 0, 'seq18', False], 
-                  ['seq19', 0, 'seq19|seq20', True], 
-                  ['seq20', 0, 'seq19|seq20', True],
-                  ['seq21', 0, 'seq21', True], 
-                  ['seq21', 1, 'seq21|seq22|seq23', True],
-                  ['seq22', 1, 'seq22', False],
-                  ['seq23', 1, 'seq21|seq22|seq23', True], 
-                  ['seq23', 2, 'seq23', True]]
-            )
-        test_kmers, test_seqs = _tidy_sequence_set(clean_kmer, set([]))
-        self.assertEqual(test_seqs, known_seqs)
-        # Makes testing easier
-        test_kmers = test_kmers
-        test_kmers['shared-set'] =  \
-            test_kmers['shared-set'].apply(lambda x: "|".join(sorted(x)))
-        pdt.assert_frame_equal(known_kmers, test_kmers)
+        long_ = clean_kmer.explode('shared-set')
+        long_.rename(columns={'shared-set': 'value'}, inplace=True)
+        names, shared = _intersect_shared_seqs(long_)
+        known_sets = [{'seq00'}, {'seq01'}, {'seq02'}, {'seq05'}, {'seq06'},
+                      {'seq07'}, {'seq09'}, {'seq10', 'seq11'}, {'seq16'}, 
+                      {'seq17'}, {'seq19', 'seq20'}, {'seq21'}, {'seq23'}]
+
+        test = _tidy_sequence_set(shared)
+        test_sets = pd.Series(names[test >= 0]).groupby(test[test >= 0])
+        test_sets = [set(x) for _, x in test_sets]
+        self.assertEqual(sorted(known_sets, key=sorted), 
+                         sorted(test_sets, key=sorted))
 
     def test_untangle_database_ids(self):
         matches = pd.DataFrame(
@@ -885,6 +1119,23 @@ class ReconstructTest(TestCase):
 
         pdt.assert_series_equal(known_seq, seq_.sort_index())
 
+    def test_untangle_database_ids_degenerate_shared(self):
+        # seq1 has an R where seq2 has an A, so the expansion seq1@0001 
+        # shares its kmer with seq2 and the two can't be told apart
+        matches = pd.DataFrame(
+            data=np.array([['seq1', 'seq1@0001', 'seq1@0001|seq2', '0'],
+                           ['seq1', 'seq1@0002', 'seq1@0002', '0'],
+                           ['seq2', 'seq2', 'seq1@0001|seq2', '0'],
+                           ], dtype=object),
+            columns=['db-seq', 'seq-name', 'kmer', 'region'],
+            )
+        matches['region'] = matches['region'].astype(int)
+        known_seq = pd.Series({'seq1': 'seq1|seq2', 'seq2': 'seq1|seq2'}, 
+                              name='clean_name')
+        known_seq.index.set_names('db-seq', inplace=True)
+        seq_ = _untangle_database_ids(matches, num_regions=1)
+        pdt.assert_series_equal(known_seq, seq_.sort_index())
+
 def test_untangle_database_ids_linked():
         matches = pd.DataFrame(
             data=np.array([['seq00', 'seq00', 'seq00', '0'],
@@ -1,9 +1,12 @@
 from unittest import TestCase, main
 
 import os
+import tempfile
 
 import dask
+from dask.distributed import Client
 import numpy as np
+import numpy.testing as npt
 import pandas as pd
 import pandas.testing as pdt
 import skbio
@@ -11,9 +14,18 @@ import skbio
 from qiime2 import Artifact, Metadata
 from qiime2.plugin import ValidationError
 
-from q2_sidle._utils import (_count_degenerates,
+from q2_sidle._utils import (_check_client_compatible,
+                             _client_registry,
+                             _count_degenerates,
+                             _count_packed_degenerates,
+                             _count_set_nibbles,
                              _find_primer_end,
                              _find_primer_start,
+                             _pack_seqs,
+                             _packed_hamming,
+                             _ordered_map,
+                             _read_cluster_config,
+                             _setup_dask_client,
                              )
 import q2_sidle.tests.test_set as ts
 from q2_types.feature_data import DNAIterator, DNAFASTAFormat
@@ -48,6 +60,39 @@ class UtilTest(TestCase):
         test = _count_degenerates(seq_array)
         pdt.assert_series_equal(known, test)
 
+    def test_pack_seqs(self):
+        test = _pack_seqs(['CATS', 'WANT', 'CATSCATSCATSCATSCATS'])
+        self.assertEqual(test.dtype, np.uint64)
+        self.assertEqual(test.shape, (3, 2))
+        npt.assert_array_equal(test[:2, 1], np.array([0, 0]))
+        npt.assert_array_equal(_count_set_nibbles(test), 
+                               np.array([4, 4, 20]))
+
+    def test_pack_seqs_unknown_error(self):
+        with self.assertRaises(ValueError) as err:
+            _pack_seqs(['ACGT', 'acgt'])
+        self.assertEqual(str(err.exception),
+                         "Sequences can only contain the uppercase IUPAC "
+                         "nucleotide codes. 'a' is not a nucleotide code.")
+
+    def test_count_packed_degenerates(self):
+        test = _count_packed_degenerates(
+            _pack_seqs(['AGTC', 'ARWS', 'CTWK', 'GTCM', 'ATGN', 'NNNNNNNN'])
+            )
+        npt.assert_array_equal(test, np.array([0, 3, 2, 1, 1, 8]))
+
+    def test_packed_hamming(self):
+        known = np.array([[0, 3, 1],
+                          [3, 0, 3],
+                          [4, 4, 4]])
+        seqs1 = _pack_seqs(['AGTC', 'WGWN', 'GTCM'])
+        seqs2 = _pack_seqs(['AGTC', 'WGWN', 'AGTT'])
+        npt.assert_array_equal(known, _packed_hamming(seqs1, seqs2))
+
+    def test_ordered_map(self):
+        test = _ordered_map(lambda x, y: x * y, iter([1, 2, 3]), y=2)
+        self.assertEqual(list(test), [2, 4, 6])
+
     def test_find_primer_start_match(self):
         known = pd.Series({'pos': 0, 'mis': 0})
         test = _find_primer_start('Cats are awesome', '(Cat){e<=1}', adj=0)
@@ -68,6 +113,83 @@ class UtilTest(TestCase):
         test = _find_primer_end('Iguanas are awesome', '(Cat){e<=1}')
         pdt.assert_series_equal(known, test)
 
+    def test_setup_dask_client_debug(self):
+        with _setup_dask_client(debug=True) as client:
+            self.assertTrue(client is None)
+
+    def test_setup_dask_client_reuse(self):
+        existing = Client(processes=False, n_workers=2, 
+                          dashboard_address=None)
+        try:
+            with _setup_dask_client(n_workers=1) as client:
+                self.assertTrue(client is existing)
+                with _setup_dask_client(n_workers=2) as nested:
+                    self.assertTrue(nested is existing)
+            self.assertEqual(existing.status, 'running')
+            self.assertEqual(_client_registry, {})
+        finally:
+            existing.close()
+
+    def test_setup_dask_client_local_scheduler(self):
+        config = {'scheduler': 'synchronous'}
+        with _setup_dask_client(cluster_config=config) as client:
+            self.assertTrue(client is None)
+            self.assertEqual(dask.config.get('scheduler'), 'synchronous')
+        self.assertEqual(_client_registry, {})
+
+    def test_read_cluster_config(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fp = os.path.join(tmp, 'cluster.yml')
+            with open(fp, 'w') as f_:
+                f_.write('scheduler: distributed\nn_workers: 2\n'
+                         'threads_per_worker: 4\nmemory_limit: 2GB\n'
+                         'processes: false\n')
+            self.assertEqual(_read_cluster_config(fp), {
+                'scheduler': 'distributed', 
+                'n_workers': 2,
+                'threads_per_worker': 4,
+                'memory_limit': '2GB',
+                'processes': False,
+                })
+
+    def test_read_cluster_config_json(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fp = os.path.join(tmp, 'cluster.json')
+            with open(fp, 'w') as f_:
+                f_.write('{"scheduler": "threads", "n_workers": 3}')
+            self.assertEqual(_read_cluster_config(fp), 
+                             {'scheduler': 'threads', 'n_workers': 3})
+
+    def test_read_cluster_config_error(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fp = os.path.join(tmp, 'cluster.yml')
+            with open(fp, 'w') as f_:
+                f_.write('n_workers: 2\nworkers: 4\n')
+            with self.assertRaises(ValueError) as err:
+                _read_cluster_config(fp)
+            self.assertTrue('unrecognized options: workers' 
+                            in str(err.exception))
+            with open(fp, 'w') as f_:
+                f_.write('scheduler: slurm\n')
+            with self.assertRaises(ValueError):
+                _read_cluster_config(fp)
+
+    def test_check_client_compatible(self):
+        self.assertFalse(_check_client_compatible(None))
+        client = Client(processes=False, n_workers=2, dashboard_address=None)
+        try:
+            self.assertTrue(_check_client_compatible(client, n_workers=0))
+            self.assertTrue(_check_client_compatible(client, n_workers=2))
+            self.assertFalse(_check_client_compatible(client, n_workers=3))
+            self.assertTrue(_check_client_compatible(
+                client, address=client.scheduler.address
+                ))
+            self.assertFalse(_check_client_compatible(
+                client, address='tcp://10.0.0.1:8786'
+                ))
+        finally:
+            client.close()
+
 
 if __name__ == '__main__':
     main()
\ No newline at end of file